@@ -0,0 +1,79 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest2
+from well_rested_unittest.cache import MetadataCache, Timings
+
+
+class TestMetadataCache(unittest2.TestCase):
+
+    concurrency = 4
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, '.wrt-cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_and_load(self):
+        cache = MetadataCache(self.path, 'a')
+        self.assertFalse(cache.loaded)
+        cache.set('project_url', 'http://server/api/projects/1/')
+        cache.update('fixtures', {'_Resource': 'http://server/api/cases/2/'})
+        cache.save()
+        cache = MetadataCache(self.path, 'a')
+        self.assertTrue(cache.loaded)
+        self.assertEqual(cache.get('project_url'), 'http://server/api/projects/1/')
+        self.assertEqual(cache.get('fixtures'),
+                         {'_Resource': 'http://server/api/cases/2/'})
+
+    def test_keys_kept_apart(self):
+        cache = MetadataCache(self.path, 'a')
+        cache.set('user_url', 'a')
+        cache.save()
+        cache = MetadataCache(self.path, 'b')
+        cache.set('user_url', 'b')
+        cache.save()
+        self.assertEqual(MetadataCache(self.path, 'a').get('user_url'), 'a')
+        self.assertEqual(MetadataCache(self.path, 'b').get('user_url'), 'b')
+
+    def test_expired(self):
+        cache = MetadataCache(self.path, 'a', expire_seconds=60)
+        cache.set('user_url', 'a')
+        cache.entry['created'] = time.time() - 61
+        cache.save()
+        cache = MetadataCache(self.path, 'a', expire_seconds=60)
+        self.assertFalse(cache.loaded)
+        self.assertIsNone(cache.get('user_url'))
+
+    def test_no_path(self):
+        cache = MetadataCache(None, 'a')
+        cache.set('user_url', 'a')
+        cache.save()
+        self.assertEqual(cache.get('user_url'), 'a')
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class TestTimings(unittest2.TestCase):
+
+    concurrency = 4
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, '.wrt-timings')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_merges(self):
+        Timings(self.path).save({'a': 1.0, 'b': 2.0})
+        Timings(self.path).save({'b': 3.0})
+        timings = Timings(self.path)
+        self.assertEqual(timings.get('a'), 1.0)
+        self.assertEqual(timings.get('b'), 3.0)
+        self.assertNotIn('c', timings)
+
+    def test_missing_file(self):
+        self.assertIsNone(Timings(self.path).get('a'))
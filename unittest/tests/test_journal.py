@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import unittest2
+import StringIO
+from well_rested_unittest import wrtclient, content, replay
+from well_rested_unittest.journal import Journal, decode_details
+
+
+class FakeClient(object):
+    """Records the calls replay makes instead of sending them."""
+
+    calls = []
+
+    def __init__(self, wrt_conf, stream, run_url=None, **kwargs):
+        self._run_url = run_url or 'http://wrt/runs/1/'
+
+    def dumpState(self, path):
+        pass
+
+    def loadState(self, path):
+        pass
+
+    def close(self):
+        pass
+
+    def registerTests(self, tests):
+        self.calls.append(('registerTests', [test.id() for test in tests]))
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            if args:
+                args = (args[0].id(),) + args[1:]
+            self.calls.append((name,) + args + (sorted(kwargs),))
+        return call
+
+
+class TestOfflineJournal(unittest2.TestCase):
+
+    concurrency = 4
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, '.wrt-journal')
+        self.stream = unittest2.runner._WritelnDecorator(StringIO.StringIO())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records_without_sending(self):
+        client = wrtclient.WRTClient(
+            '.wrt-sample-tests.conf', self.stream, journal=self.path,
+            offline=True, tag_values=[('REVISION', 'abc')])
+        client.startTestRun(timestamp='2016-01-01T00:00:00')
+        client.registerTests([self])
+        client.startTest(self, timestamp='2016-01-01T00:00:01')
+        details = client.markTestStatus(
+            self, 'fail', reason='Exception',
+            details={'traceback': content.text_content('boom')})
+        self.assertEqual(details['traceback'].as_text(), 'boom')
+        client.stopTest(self, timestamp='2016-01-01T00:00:02', duration=1.0)
+        client.stopTestRun(timestamp='2016-01-01T00:00:03', status='fail')
+
+        records = list(Journal.read(self.path))
+        self.assertEqual(
+            [record['event'] for record in records],
+            ['startTestRun', 'registerTests', 'startTest',
+             'markTestStatus', 'stopTest', 'stopTestRun'])
+        self.assertEqual(records[0]['tags'], [['REVISION', 'abc']])
+        self.assertTrue(records[0]['offline'])
+        self.assertEqual(records[1]['names'], [self.id()])
+        self.assertEqual(records[3]['id'], self.id())
+        self.assertEqual(records[3]['args'], ['fail'])
+        details = decode_details(records[3]['kwargs']['details'])
+        self.assertEqual(details['traceback'].as_text(), 'boom')
+        self.assertEqual(details['traceback'].content_type,
+                         content.UTF8_TEXT)
+
+    def test_replay(self):
+        client = wrtclient.WRTClient(
+            '.wrt-sample-tests.conf', self.stream, journal=self.path,
+            offline=True)
+        client.startTestRun(timestamp='2016-01-01T00:00:00')
+        client.registerTests([self])
+        client.startTest(self, timestamp='2016-01-01T00:00:01')
+        client.markTestStatus(
+            self, 'fail', reason='Exception',
+            details={'traceback': content.text_content('boom')})
+        client.stopTest(self, timestamp='2016-01-01T00:00:02', duration=1.0)
+        client.stopTestRun(timestamp='2016-01-01T00:00:03', status='fail')
+
+        self.addCleanup(setattr, replay.wrtclient, 'WRTClient',
+                        replay.wrtclient.WRTClient)
+        replay.wrtclient.WRTClient = FakeClient
+        FakeClient.calls = []
+        replay.replay(self.path, '.wrt-sample-tests.conf', self.stream)
+        self.assertEqual(FakeClient.calls, [
+            ('startTestRun', ['timestamp']),
+            ('registerTests', [self.id()]),
+            ('startTest', self.id(), ['timestamp']),
+            ('markTestStatus', self.id(), 'fail', ['details', 'reason']),
+            ('stopTest', self.id(), ['duration', 'timestamp']),
+            ('stopTestRun', ['status', 'timestamp']),
+        ])
+
+    def test_live_run_not_replayed(self):
+        # as a run recorded without --offline is
+        journal = Journal(self.path)
+        journal.record('startTestRun', run_url=None, timestamp='2016-01-01T00:00:00',
+                       tags=[], offline=False)
+        journal.record('stopTestRun', timestamp='2016-01-01T00:00:03',
+                       kwargs={'status': 'pass'})
+
+        self.addCleanup(setattr, replay.wrtclient, 'WRTClient',
+                        replay.wrtclient.WRTClient)
+        replay.wrtclient.WRTClient = FakeClient
+        FakeClient.calls = []
+        self.assertRaises(wrtclient.WRTException, replay.replay,
+                          self.path, '.wrt-sample-tests.conf', self.stream)
+        self.assertEqual(FakeClient.calls, [])
+        replay.replay(self.path, '.wrt-sample-tests.conf', self.stream, force=True)
+        self.assertEqual(FakeClient.calls, [
+            ('startTestRun', ['timestamp']),
+            ('stopTestRun', ['status', 'timestamp']),
+        ])
+
+    def test_partial_line_ignored(self):
+        Journal(self.path).record('startTestRun', run_url=None)
+        with open(self.path, 'ab') as f:
+            f.write('{"event": "stopTe')
+        self.assertEqual([record['event'] for record in Journal.read(self.path)],
+                         ['startTestRun'])
+
+    def test_offline_requires_journal(self):
+        self.assertRaises(wrtclient.WRTException, wrtclient.WRTClient,
+                          '.wrt-sample-tests.conf', self.stream, offline=True)
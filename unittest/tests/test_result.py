@@ -1,7 +1,11 @@
+import os
 import sys
+import argparse
+import threading
 import unittest2
 import well_rested_unittest
 import testtools
+from well_rested_unittest.records import read_record, write_record, WorkerProgress
 
 
 class ExampleException(Exception):
@@ -50,6 +54,133 @@ class TestWellRestedTestResult(unittest2.TestCase):
         result.addFailure('test2', err=self.err)
         self.assertFalse(result.shouldStop)
 
+    def test_absorb_streamed_results(self):
+        records, send = os.pipe()
+        self.addCleanup(os.close, records)
+        worker = well_rested_unittest.WellRestedTestResult(
+            verbosity=0, failing_file="", timings_file=None)
+        worker.stream_fd = send
+        worker.addFailure('test1', err=self.err)
+        worker.streamResults()
+        worker.addSkip('test2', reason='skipped')
+        worker.streamResults()
+        worker.streamResults()  # nothing new, nothing sent
+        os.close(send)
+        parent = well_rested_unittest.WellRestedTestResult(
+            failfast=True, verbosity=0, failing_file="", timings_file=None)
+        streamed = list(iter(lambda: read_record(records), None))
+        self.assertEqual(len(streamed), 2)
+        parent.absorbRecord(streamed[0])
+        self.assertEqual(len(parent.failures), 1)
+        self.assertEqual(parent.reasons, {'ExampleException': 1})
+        # failing fast across workers
+        self.assertTrue(parent.shouldStop)
+        parent.absorbRecord(streamed[1])
+        self.assertEqual(parent.skipped, [['test2', 'skipped']])
+
+    def test_heartbeats_not_absorbed(self):
+        records, send = os.pipe()
+        self.addCleanup(os.close, records)
+        write_record(send, {'started': 'test1'})
+        write_record(send, {'heartbeat': True})
+        write_record(send, {'done': True})
+        os.close(send)
+        result = well_rested_unittest.WellRestedTestResult(
+            verbosity=0, failing_file="", timings_file=None)
+        absorbed = []
+        result.absorbRecord = absorbed.append
+        self.assertTrue(WorkerProgress().absorb(result, records, timeout=5))
+        self.assertEqual(absorbed, [{'started': 'test1'}])
+
+    def test_stop_workers(self):
+        class WorkerResult(well_rested_unittest.WellRestedTestResult):
+            # apart from the listener of the worker running this test
+            _listenLock = threading.Lock()
+            _listener = None
+            _listening = None
+            _stopRequested = False
+
+        listen, stop = os.pipe()
+        self.addCleanup(os.close, listen)
+        self.addCleanup(os.close, stop)
+        worker = WorkerResult(verbosity=0, failing_file="", timings_file=None)
+        worker.listenForStop(listen)
+        parent = well_rested_unittest.WellRestedTestResult(
+            verbosity=0, failing_file="", timings_file=None)
+        parent.addControl(stop)
+        self.assertFalse(worker.shouldStop)
+        parent.stop()
+        WorkerResult._listener.join(5)
+        self.assertTrue(worker.shouldStop)
+        # as are the worker's results for later batches
+        later = WorkerResult(verbosity=0, failing_file="", timings_file=None)
+        later.listenForStop(listen)
+        self.assertTrue(later.shouldStop)
+
+    def test_fixture_fail_percent(self):
+        result = well_rested_unittest.WellRestedTestResult(
+            verbosity=0, failing_file="", fail_percent=50, timings_file=None)
+        result._expected_tests = 10
+        result.reasons['Error handling fixtures'] = 5
+        self.assertFalse(result._tooManyFixtureFailures())
+        result.reasons['Error handling fixtures'] = 6
+        self.assertTrue(result._tooManyFixtureFailures())
+
+    def test_server_calls_outside_lock(self):
+        entered = threading.Event()
+        release = threading.Event()
+
+        class SlowClient(object):
+            def markTestStatus(self, test, status, **kwargs):
+                entered.set()
+                release.wait(5)
+
+        result = well_rested_unittest.WellRestedTestResult(
+            verbosity=0, failing_file="", timings_file=None)
+        result.wrt_client = SlowClient()
+        reporter = threading.Thread(target=result.addSuccess, args=(self,))
+        reporter.start()
+        self.addCleanup(reporter.join, 5)
+        self.addCleanup(release.set)
+        self.assertTrue(entered.wait(5))
+        # other threads can report while this one waits on the server
+        self.assertTrue(result.reportLock.acquire(False))
+        result.reportLock.release()
+
+    def test_aborted_reported_outside_absorb_lock(self):
+        entered = threading.Event()
+        release = threading.Event()
+
+        class SlowClient(object):
+            def markTestStatus(self, test, status, **kwargs):
+                entered.set()
+                release.wait(5)
+                return kwargs.get('details')
+
+        result = well_rested_unittest.WellRestedTestResult(
+            verbosity=0, failing_file="", timings_file=None)
+        result.wrt_client = SlowClient()
+        reporter = threading.Thread(target=result.addAborted,
+                                    args=('test1', 'Worker 1 exited'))
+        reporter.start()
+        self.addCleanup(reporter.join, 5)
+        self.addCleanup(release.set)
+        self.assertTrue(entered.wait(5))
+        # other workers' results can be absorbed meanwhile
+        self.assertTrue(result.absorbLock.acquire(False))
+        result.absorbLock.release()
+
+    def test_timings_kept_when_needed(self):
+        def timings_file(**flags):
+            flags = argparse.Namespace(progName='wrtest', failing_file='', **flags)
+            cls = well_rested_unittest.WellRestedTestResult
+            return cls.factory(cls, flags).timings_file
+        self.assertIsNone(timings_file(timings_file=None, schedule='static'))
+        self.assertEqual(timings_file(timings_file=None, schedule='duration'),
+                         '.wrt-timings')
+        self.assertEqual(timings_file(timings_file='times', schedule='static'),
+                         'times')
+
     def test_fail_on_uxsuccess(self):
         result = well_rested_unittest.WellRestedTestResult(
             uxsuccess_not_failure=False, verbosity=0, failing_file="")
@@ -1,11 +1,23 @@
 import unittest2
+import threading
 import time
 import os
+import signal
+import random
+import shutil
+import tempfile
+import testresources
 import sample_tests
 from testresources import OptimisingTestSuite
 from well_rested_unittest import (
     AutoDiscoveringTestLoader,  WellRestedTestResult,
-    ErrorTolerantOptimisedTestSuite, ResourcedTestCase)
+    ErrorTolerantOptimisedTestSuite, ResourcedTestCase, ReportingTestResourceManager,
+    addDetail_upStack, text_content)
+from well_rested_unittest.suite import (
+    ForkedSuite, WorkStealingQueues, Slots, ThreadedSuite, _threaded_worker)
+from well_rested_unittest.pool import WorkerPool
+from well_rested_unittest.cache import Timings
+from sample_tests.resources import Resource, ResourceARM, ResourceBRM
 
 
 class TestErrorTolerantOptimisedTestSuite(ResourcedTestCase):
@@ -89,6 +101,66 @@ class TestErrorTolerantOptimisedTestSuite(ResourcedTestCase):
             ])
 
 
+class RecordingResource(ReportingTestResourceManager):
+
+    def __init__(self, name, log, fail_clean=False):
+        super(RecordingResource, self).__init__()
+        self.name = name
+        self.log = log
+        self.fail_clean = fail_clean
+
+    def make(self, dependency_resources):
+        self.log.append('make ' + self.name)
+        return self.name
+
+    def clean(self, resource):
+        self.log.append('clean ' + self.name)
+        if self.fail_clean:
+            raise Exception('clean failed')
+
+
+class TestSwitch(unittest2.TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.result = WellRestedTestResult(verbosity=0, failing_file="")
+
+    def test_current_resources_per_suite(self):
+        outer = ErrorTolerantOptimisedTestSuite([])
+        inner = ErrorTolerantOptimisedTestSuite([])
+        outer.current_resources.add('resource')
+        self.assertEqual(inner.current_resources, set())
+
+    def test_setup_in_listed_order(self):
+        names = 'cabfed'
+        log = self.log
+
+        class OrderedTest(ResourcedTestCase):
+            resources = [(name, RecordingResource(name, log))
+                         for name in names]
+
+            def test_resources(self):
+                pass
+
+        suite = ErrorTolerantOptimisedTestSuite(
+            [OrderedTest('test_resources')])
+        suite.run(self.result)
+        self.assertEqual(
+            self.log[:len(names)], ['make ' + name for name in names])
+
+    def test_teardown_in_reverse_past_failure(self):
+        resources = [RecordingResource('a', self.log),
+                     RecordingResource('b', self.log, fail_clean=True),
+                     RecordingResource('c', self.log)]
+        suite = ErrorTolerantOptimisedTestSuite([])
+        suite.switch(testresources._OrderedSet(resources), self.result)
+        self.assertRaises(
+            Exception, suite.switch, testresources._OrderedSet(), self.result)
+        self.assertEqual(
+            self.log[3:], ['clean c', 'clean b', 'clean a'])
+        self.assertEqual(len(suite.current_resources), 0)
+
+
 class TestParallelErrorTolerantOptimisedTestSuite(ResourcedTestCase):
     """Also tests ReportingTestResourceManager."""
 
@@ -152,3 +224,437 @@ class TestParallelErrorTolerantOptimisedTestSuite(ResourcedTestCase):
         self.assertEqual(len(result.warnings), 3, result.warnings)
         self.assertIn(len(result.errors), (4, 5), result.errors)
 
+    def test_parallel_fork(self):
+        loader = AutoDiscoveringTestLoader(
+            suiteClass=ErrorTolerantOptimisedTestSuite)
+        suite = loader.loadTestsFromNames(['sample_tests'], None)
+        suite.parallel = True
+        suite.fork = True
+        suite.testNames = ['sample_tests']
+        result = WellRestedTestResult(verbosity=0, failing_file="", progName='wrtest')
+        suite.run(result)
+        self.assertEqual([worker.__class__ for worker in suite._tests],
+                         [ForkedSuite, ForkedSuite])
+        # the workers are gone once the suite has run
+        self.assertIsNone(suite.pool)
+        # the results represent the collection
+        self.assertEqual(result.testsRun, 17)
+        self.assertIn(len(result.failures), (1, 2), result.failures)
+        self.assertEqual(len(result.skipped), 2, result.skipped)
+        self.assertEqual(len(result.expectedFailures), 2, result.expectedFailures)
+        self.assertEqual(len(result.unexpectedSuccesses), 2, result.unexpectedSuccesses)
+        self.assertEqual(len(result.warnings), 3, result.warnings)
+        self.assertIn(len(result.errors), (4, 5), result.errors)
+
+    def test_parallel_dynamic(self):
+        loader = AutoDiscoveringTestLoader(
+            suiteClass=ErrorTolerantOptimisedTestSuite)
+        suite = loader.loadTestsFromNames(['sample_tests'], None)
+        suite.parallel = True
+        suite.schedule = 'dynamic'
+        suite.fork = True
+        suite.testNames = ['sample_tests']
+        result = WellRestedTestResult(verbosity=0, failing_file="", progName='wrtest')
+        suite.run(result)
+        self.assertEqual([worker.__class__ for worker in suite._tests],
+                         [ForkedSuite, ForkedSuite])
+        self.assertIsNone(suite.pool)
+        self.assertEqual(result.testsRun, 17)
+        self.assertEqual(len(result.skipped), 2, result.skipped)
+        self.assertEqual(len(result.expectedFailures), 2, result.expectedFailures)
+        self.assertEqual(len(result.unexpectedSuccesses), 2, result.unexpectedSuccesses)
+
+    def test_parallel_auto(self):
+        loader = AutoDiscoveringTestLoader(
+            suiteClass=ErrorTolerantOptimisedTestSuite)
+        suite = loader.loadTestsFromNames(['sample_tests'], None)
+        suite.concurrency = 'auto'
+        suite.testNames = ['sample_tests']
+        result = WellRestedTestResult(verbosity=0, failing_file="", progName='wrtest')
+        suite.run(result)
+        # the sample tests have concurrency 1, so a group of one worker
+        self.assertEqual(suite.slots.total, 1)
+        self.assertEqual(result.testsRun, 17)
+        self.assertEqual(len(result.skipped), 2, result.skipped)
+        self.assertEqual(len(result.expectedFailures), 2, result.expectedFailures)
+
+    def test_parallel_duration(self):
+        loader = AutoDiscoveringTestLoader(
+            suiteClass=ErrorTolerantOptimisedTestSuite)
+        suite = loader.loadTestsFromNames(['sample_tests'], None)
+        long_test = 'sample_tests.test_resourced_test_case.TestResourcedTestCase.test_xpass'
+        timings = dict((test.id(), 1.0) for test in suite._tests)
+        timings[long_test] = 100.0
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        suite.timings_file = os.path.join(directory, '.wrt-timings')
+        Timings(suite.timings_file).save(timings)
+        suite.parallel = True
+        suite.schedule = 'duration'
+        suite.testNames = ['sample_tests']
+        workers = [[test.id() for test in tests]
+                   for tests in suite.packByDuration(*self.partitions(suite))]
+        # the long test has a worker to itself
+        self.assertIn([long_test], workers)
+        self.assertEqual(sum(len(tests) for tests in workers), 17)
+
+    @staticmethod
+    def partitions(suite):
+        resource_set_tests = testresources.split_by_resources(suite._tests)
+        graph = testresources._resource_graph(resource_set_tests)
+        return resource_set_tests, testresources._strongly_connected_components(
+            graph, frozenset())
+
+
+class TestMeasuredResourceCosts(unittest2.TestCase):
+
+    concurrency = 4
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        loader = AutoDiscoveringTestLoader(
+            suiteClass=ErrorTolerantOptimisedTestSuite)
+        self.suite = loader.loadTestsFromNames(['sample_tests'], None)
+        self.suite.timings_file = os.path.join(directory, '.wrt-timings')
+
+    def test_measured_costs_used(self):
+        Timings(self.suite.timings_file).save({
+            'Creating_ResourceA': 2.0, 'Destroying_ResourceA': 2.0})
+        self.assertEqual(self.suite.cost_of_switching(
+            frozenset([ResourceARM]), frozenset()), 2.0)
+        # untimed, ResourceB's setUpCost of 2 is scaled like ResourceA's
+        self.assertEqual(self.suite.cost_of_switching(
+            frozenset([ResourceARM]), frozenset([ResourceARM, ResourceBRM])), 4.0)
+
+    def test_durations_recorded(self):
+        result = WellRestedTestResult(verbosity=0, failing_file="",
+                                      timings_file=self.suite.timings_file)
+        result.startTestRun()
+        self.suite.run(result)
+        result.stopTestRun()
+        timings = Timings(self.suite.timings_file)
+        self.assertIn('Creating_ResourceA', timings)
+        self.assertIn('Destroying_ResourceA', timings)
+        self.assertIn('sample_tests.test_class.TestClass1.test_1', timings)
+
+
+class TestGreedyOrder(unittest2.TestCase):
+
+    concurrency = 4
+
+    def test_large_partition(self):
+        rand = random.Random(1)
+        resources = []
+        for i in range(30):
+            resource = testresources.TestResourceManager()
+            resource.setUpCost = rand.randint(1, 10)
+            resource.tearDownCost = rand.randint(1, 3)
+            resources.append(resource)
+        resource_sets = set()
+        while len(resource_sets) < 80:
+            resource_sets.add(frozenset(rand.sample(resources, rand.randint(1, 4))))
+        suite = ErrorTolerantOptimisedTestSuite([])
+        suite._resource_costs = {}
+        for resource in resources:
+            suite._resource_costs[resource, 'Creating'] = resource.setUpCost
+            suite._resource_costs[resource, 'Destroying'] = resource.tearDownCost
+
+        def cost(order):
+            order = [frozenset()] + order + [frozenset()]
+            return sum(suite.cost_of_switching(order[i], order[i + 1])
+                       for i in range(len(order) - 1))
+
+        order = suite._makeOrder(set(resource_sets))
+        self.assertEqual(len(order), len(resource_sets))
+        self.assertEqual(set(order), resource_sets)
+        # at least as good as testresources' order
+        self.assertLessEqual(cost(order), cost(OptimisingTestSuite._makeOrder(
+            suite, set(resource_sets))))
+
+
+class SlowResource(ReportingTestResourceManager):
+
+    resources = []
+
+    def make(self, dependency_resources):
+        print 'making %s' % self.name
+        self.logger.info('making %s', self.name)
+        time.sleep(0.3)
+        return Resource()
+
+    def clean(self, resource):
+        pass
+
+
+class SlowResourceA(SlowResource):
+    name = 'a'
+
+
+class SlowResourceB(SlowResource):
+    name = 'b'
+
+
+class DependentResource(SlowResource):
+    name = 'c'
+
+
+class SlowResourcesTest(ResourcedTestCase):
+
+    def test_resources(self):
+        pass
+
+
+class TestSetupThreads(unittest2.TestCase):
+
+    def test_independent_resources_at_once(self):
+        a, b = SlowResourceA(), SlowResourceB()
+        c = DependentResource()
+        c.resources = [('a', a)]
+        test = SlowResourcesTest('test_resources')
+        test.resources = [('b', b), ('c', c)]
+        suite = ErrorTolerantOptimisedTestSuite([test], setup_threads=2)
+        result = WellRestedTestResult(verbosity=0, failing_file="", timings_file=None,
+                                      store_pass=True)
+        start = time.time()
+        suite.run(result)
+        # a and b at once, then c
+        self.assertLess(time.time() - start, 0.85)
+        self.assertEqual(result.testsRun, 1)
+        self.assertEqual(result.errors, [])
+        # each resource's output and logging is its own
+        infos = dict(result.infos)
+        for resource in (a, b, c):
+            details = infos['Creating_%s' % resource.__class__.__name__]
+            for other in (a, b, c):
+                if other is resource:
+                    self.assertIn('stdout: {{{making %s' % other.name, details)
+                    self.assertIn('INFO] %s' % other.__class__.__name__, details)
+                else:
+                    self.assertNotIn('making %s' % other.name, details)
+
+
+class PlainResource(ReportingTestResourceManager):
+
+    resources = []
+
+    def make(self, dependency_resources):
+        return Resource()
+
+
+class TestIsDirty(unittest2.TestCase):
+
+    def test_dependencies_checked_once_per_change(self):
+        a, b, c = PlainResource(), PlainResource(), PlainResource()
+        b.resources = [('a', a)]
+        c.resources = [('b', b)]
+        result = WellRestedTestResult(verbosity=0, failing_file="", timings_file=None)
+        resource = c.getResource(result)
+        checks = []
+        get_resource = b.getResource
+        b.getResource = lambda result=None: checks.append(1) or get_resource(result)
+        self.assertFalse(c.isDirty())
+        self.assertFalse(c.isDirty())
+        self.assertEqual(len(checks), 1)
+        # dirtying a moves things on
+        a.dirtied(resource.b.a)
+        self.assertTrue(c.isDirty())
+        self.assertIsNot(c.getResource(result), resource)
+
+
+class TestAddDetailUpStack(unittest2.TestCase):
+
+    def test_from_nested_helper(self):
+        def helper():
+            nested()
+
+        def nested():
+            addDetail_upStack('a_thing', text_content('found it'))
+
+        details = []
+
+        class Tests(ResourcedTestCase):
+            def test_a(self):
+                helper()
+                details.append(self.getDetails())
+
+        result = WellRestedTestResult(verbosity=0, failing_file="", timings_file=None)
+        Tests('test_a').run(result)
+        self.assertEqual(result.testsRun, 1)
+        self.assertEqual(details[0]['a_thing'].as_text(), 'found it')
+
+    def test_no_test_on_stack(self):
+        # in a thread of its own, so not even this test is on the stack
+        errors = []
+
+        def add():
+            try:
+                addDetail_upStack('a_thing', text_content('lost'))
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=add)
+        thread.start()
+        thread.join(5)
+        self.assertEqual(errors, [])
+
+
+class TestWorkStealingQueues(unittest2.TestCase):
+
+    def test_steals_from_busiest(self):
+        queues = WorkStealingQueues(2)
+        queues.add([[1, 2, 3], [4]])
+        queues.add([[5]])
+        self.assertEqual(queues.next(2), [5])
+        # worker 2 has nothing of its own left, so takes from the end of 1's
+        self.assertEqual(queues.next(2), [4])
+        self.assertEqual(queues.next(1), [1, 2, 3])
+        self.assertIsNone(queues.next(1))
+
+
+class TestWorkerSupervision(unittest2.TestCase):
+
+    def runInPool(self, misbehave, timeout=0, held=None):
+        parent = os.getpid()
+
+        # only misbehaves in the worker
+        class Tests(unittest2.TestCase):
+            def test_a(self):
+                pass
+
+            def test_b(self):
+                if os.getpid() != parent:
+                    misbehave()
+
+            def test_c(self):
+                if held:
+                    with held:
+                        pass
+
+        tests = list(unittest2.TestLoader().loadTestsFromTestCase(Tests))
+        pool = WorkerPool(tests, ErrorTolerantOptimisedTestSuite,
+                          WellRestedTestResult, 'wrtest', timeout=timeout)
+        result = WellRestedTestResult(verbosity=0, failing_file="",
+                                      timings_file=None)
+        pool.start(1)
+        release = threading.Event()
+        if held:
+            # held by another thread while the worker is replaced
+            holder = threading.Thread(
+                target=lambda: held.acquire() and release.wait())
+            holder.start()
+            while not held.locked():
+                time.sleep(0.01)
+        try:
+            pool.run(1, [test.id() for test in tests], result)
+        finally:
+            release.set()
+            if held:
+                holder.join()
+                held.release()
+            pool.close()
+        self.assertEqual(result.testsRun, 3)
+        self.assertEqual([test for test, _ in result.errors], [tests[1].id()])
+        self.assertEqual(result.reasons, {'Worker aborted': 1})
+        return result.errors[0][1]
+
+    def test_crashed_worker_replaced(self):
+        error = self.runInPool(lambda: os._exit(1))
+        self.assertIn('Worker 1 exited while running this test', error)
+
+    def test_hung_worker_replaced(self):
+        error = self.runInPool(lambda: time.sleep(30), timeout=1)
+        self.assertIn('Worker 1 timed out while running this test', error)
+
+    def test_stopped_worker_replaced(self):
+        # not even its heartbeat gets through
+        error = self.runInPool(lambda: os.kill(os.getpid(), signal.SIGSTOP),
+                               timeout=1)
+        self.assertIn('Worker 1 stopped responding while running this test', error)
+
+    def test_replaced_while_a_thread_holds_a_lock(self):
+        # a worker forked from this process now would wait for the lock
+        # forever, so give up on it after a while
+        error = self.runInPool(lambda: os._exit(1), timeout=5,
+                               held=threading.Lock())
+        self.assertIn('Worker 1 exited while running this test', error)
+
+
+class TestSlots(unittest2.TestCase):
+
+    def test_need(self):
+        slots = Slots(4)
+        self.assertEqual([slots.need(c) for c in (1, 2, 3, 4)], [4, 2, 2, 1])
+
+    def test_groups_overlap(self):
+        slots = Slots(4)
+        # two workers of a concurrency 4 group, one of a concurrency 2 group
+        self.assertEqual([slots.acquire(1), slots.acquire(1), slots.acquire(2)],
+                         [1, 2, 3])
+        slots.release(1, 2)
+        self.assertEqual(slots.free, 1)
+        self.assertEqual(slots.acquire(1), 2)
+
+    def test_waits_for_room(self):
+        slots = Slots(2)
+        first = slots.acquire(1)
+        numbers = []
+        waiting = threading.Thread(target=lambda: numbers.append(slots.acquire(2)))
+        waiting.start()
+        waiting.join(0.1)
+        # a concurrency 1 worker runs alone
+        self.assertEqual(numbers, [])
+        slots.release(1, first)
+        waiting.join(5)
+        self.assertEqual(numbers, [1])
+
+
+class SharedResource(PlainResource):
+
+    thread_policy = 'shared'
+
+
+class TestThreaded(unittest2.TestCase):
+
+    def inWorker(self, worker, function):
+        results = []
+
+        def work():
+            _threaded_worker.number = worker
+            results.append(function())
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        return results[0]
+
+    def test_resource_thread_policy(self):
+        result = WellRestedTestResult(verbosity=0, failing_file="", timings_file=None)
+        for manager, shared in ((PlainResource(), False), (SharedResource(), True)):
+            first = self.inWorker(1, lambda: manager.getResource(result))
+            second = self.inWorker(2, lambda: manager.getResource(result))
+            self.assertEqual(first is second, shared)
+            # and the same worker gets the same one again
+            self.assertIs(self.inWorker(1, lambda: manager.getResource(result)), first)
+
+    def test_threaded_workers(self):
+        # I/O bound tests, each with output of its own
+        def make(i):
+            def test(self):
+                print('test %s' % i)
+                time.sleep(0.2)
+                self.fail()
+            return test
+
+        Tests = type('Tests', (ResourcedTestCase,),
+                     dict(('test_%s' % i, make(i)) for i in range(10)))
+        suite = ErrorTolerantOptimisedTestSuite(
+            list(unittest2.TestLoader().loadTestsFromTestCase(Tests)),
+            parallel=True, concurrency=10, threaded=True)
+        result = WellRestedTestResult(verbosity=0, failing_file="", timings_file=None)
+        start = time.time()
+        suite.run(result)
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual([test.__class__ for test in suite._tests], [ThreadedSuite] * 10)
+        self.assertEqual(result.testsRun, 10)
+        self.assertEqual(len(result.failures), 10)
+        for test, details in result.failures:
+            self.assertIn('stdout: {{{test %s}}}' % test.rsplit('_', 1)[1], details)
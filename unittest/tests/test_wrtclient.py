@@ -0,0 +1,424 @@
+import os
+import json
+import requests
+import time
+import zlib
+import hashlib
+import subprocess
+import shutil
+import tempfile
+import itertools
+import threading
+import unittest2
+import StringIO
+from well_rested_unittest import (
+    wrtclient, content, WellRestedTestResult, ErrorTolerantOptimisedTestSuite,
+    ResourcedTestCase, ReportingTestResourceManager)
+
+
+class TestWRTClientHandoff(unittest2.TestCase):
+
+    concurrency = 4
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stream = unittest2.runner._WritelnDecorator(StringIO.StringIO())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_dump_and_load_state(self):
+        parent = wrtclient.WRTClient('.wrt-sample-tests.conf', self.stream)
+        parent._project_url = 'http://server/api/projects/1/'
+        parent._user_url = 'http://server/api/users/1/'
+        parent._tags = ['http://server/api/tags/1/']
+        parent._tag_values = [['REVISION', 'abc']]
+        parent._existing_tests['test_a'] = {
+            'case_id': 1, 'case_url': 'http://server/api/cases/1/',
+            'result_id': 2, 'result_url': 'http://server/api/results/2/'}
+        parent._existing_fixtures['_Resource'] = {
+            'case_url': 'http://server/api/cases/3/',
+            'result_url': 'http://server/api/results/4/'}
+        path = os.path.join(self.directory, '.wrt-handoff')
+        parent.dumpState(path)
+
+        worker = wrtclient.WRTClient('.wrt-sample-tests.conf', self.stream)
+        worker.loadState(path)
+        self.assertEqual(worker.project_url, parent.project_url)
+        self.assertEqual(worker.user_url, parent.user_url)
+        self.assertEqual(worker.tags, parent.tags)
+        self.assertEqual(worker.tagValues(), [['REVISION', 'abc']])
+        self.assertEqual(worker._existing_tests, parent._existing_tests)
+        self.assertEqual(worker._existing_fixtures,
+                         {'_Resource': {'case_url': 'http://server/api/cases/3/'}})
+        # none of it is for the next run, so none of it goes in the cache
+        for name in ('project_url', 'user_url', 'fixtures'):
+            self.assertIsNone(worker.cache.get(name))
+
+
+class TestBackgroundSender(unittest2.TestCase):
+
+    concurrency = 4
+
+    def test_calls_in_order(self):
+        calls = []
+        stream = unittest2.runner._WritelnDecorator(StringIO.StringIO())
+        sender = wrtclient.BackgroundSender(2, stream)
+        for i in range(10):
+            sender.put(calls.append, i)
+        self.assertEqual(sender.flush(), 0)
+        self.assertEqual(calls, range(10))
+        sender.stop()
+
+    def test_started_by_first_call(self):
+        stream = unittest2.runner._WritelnDecorator(StringIO.StringIO())
+        sender = wrtclient.BackgroundSender(2, stream)
+        self.assertFalse(sender.is_alive())
+        self.assertEqual(sender.flush(), 0)
+        sender.put(lambda: None)
+        self.assertTrue(sender.is_alive())
+        sender.stop()
+        # and one that never sent anything stops too
+        wrtclient.BackgroundSender(2, stream).stop()
+
+    def test_failures_counted(self):
+        def fail(client, test):
+            raise wrtclient.WRTRequestFailed('nope')
+        output = StringIO.StringIO()
+        sender = wrtclient.BackgroundSender(
+            2, unittest2.runner._WritelnDecorator(output))
+        test = wrtclient._Identity(self)
+        sender.put(fail, None, test)
+        sender.put(fail, None, test)
+        self.assertEqual(sender.flush(), 2)
+        self.assertIn('nope', output.getvalue())
+        self.assertEqual(sender.flush(), 0)
+        sender.stop()
+
+
+class TestUploadPool(unittest2.TestCase):
+
+    concurrency = 4
+
+    def setUp(self):
+        self.output = StringIO.StringIO()
+        self.pool = wrtclient.UploadPool(
+            2, unittest2.runner._WritelnDecorator(self.output), object)
+        self.addCleanup(self.pool.stop)
+
+    def test_spool(self):
+        spool = wrtclient._Spool(iter(['abc', 'def']))
+        self.assertEqual(spool.len, 6)
+        self.assertEqual(spool.read(), 'abcdef')
+        self.assertEqual(''.join(spool), 'abcdef')
+        self.assertEqual(spool.digest, hashlib.sha256('abcdef').hexdigest())
+
+    def test_gzipped_spool(self):
+        spool = wrtclient._Spool(iter(['abc'] * 1000), encoding='gzip')
+        self.assertEqual(spool.size, 3000)
+        self.assertLess(spool.len, 3000)
+        self.assertEqual(zlib.decompress(''.join(spool), 16 + zlib.MAX_WBITS),
+                         'abc' * 1000)
+        # the same content always compresses the same
+        again = wrtclient._Spool(iter(['abc'] * 1000), encoding='gzip')
+        self.assertEqual(spool.digest, again.digest)
+
+    def test_url_once_uploaded(self):
+        def upload(session, upload, name):
+            self.assertEqual(upload.spool.read(), 'stuff')
+            return 'http://server/media/%s' % name
+        pending = wrtclient._Upload(wrtclient._Spool(['stuff']))
+        self.pool.put(pending, upload, 'a')
+        self.assertEqual(self.pool.flush(), 0)
+        self.assertEqual(pending.url, 'http://server/media/a')
+
+    def test_failures_counted(self):
+        def upload(session, upload, name):
+            raise wrtclient.WRTRequestFailed('nope')
+        spool = wrtclient._Spool(['stuff'], encoding='gzip')
+        self.pool.put(wrtclient._Upload(spool), upload, 'a')
+        self.assertEqual(self.pool.flush(), 1)
+        self.assertIn('nope', self.output.getvalue())
+
+    def test_details_not_held_up(self):
+        def upload(session, upload, result_url, name, tp, filename):
+            time.sleep(1)
+            return 'http://server/media/%s' % filename
+        client = wrtclient.WRTClient('.wrt-sample-tests.conf',
+                                     unittest2.runner._WritelnDecorator(self.output))
+        client.uploadDetail = upload
+        details = {'a': content.text_content('first'),
+                   'b': content.text_content('second')}
+        start = time.time()
+        client.uploadDetails('http://server/api/results/1/', 'test', details)
+        self.assertEqual(details['a'].as_text(), 'first')
+        self.assertEqual(details['b'].as_text(), 'second')
+        self.assertLess(time.time() - start, 0.5)
+        client.close()
+        self.assertGreaterEqual(time.time() - start, 1)
+
+    def test_stripped(self):
+        self.assertEqual(
+            ''.join(wrtclient._stripped(['\n', '  a', 'b \n', ' ', 'c', ' \n', ''])),
+            'ab \n c')
+        self.assertEqual(list(wrtclient._stripped([' ', '\n'])), [])
+
+    def test_uploaded_links_shown(self):
+        uploaded = {}
+
+        def upload(session, upload, result_url, name, tp, filename):
+            data = ''.join(upload.spool)
+            if upload.spool.encoding:
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            uploaded[name] = data
+            return 'http://server/media/%s' % filename
+        client = wrtclient.WRTClient('.wrt-sample-tests.conf',
+                                     unittest2.runner._WritelnDecorator(self.output))
+        client.uploadDetail = upload
+        details = {'traceback': content.text_content('  Traceback\n'),
+                   'log': content.text_content('\n')}
+        client.uploadDetails('http://server/api/results/1/', 'test', details,
+                             shown_as='test_a')
+        client.uploadDetails('http://server/api/results/2/', 'test', details)
+        client.close()
+        # text is stripped, and what's left empty isn't uploaded
+        self.assertEqual(uploaded, {'traceback': 'Traceback'})
+        self.assertEqual(
+            self.output.getvalue().splitlines(),
+            ['Details uploaded to the well-rested-tests server:',
+             '  test_a traceback: http://server/media/test-traceback.text'])
+
+
+class TestCheckOutputs(unittest2.TestCase):
+
+    concurrency = 4
+
+    def test_run_at_once(self):
+        start = time.time()
+        self.assertEqual(
+            wrtclient.check_outputs(['sleep 0.5; echo a', 'sleep 0.5; echo b'], 5),
+            ['a\n', 'b\n'])
+        self.assertLess(time.time() - start, 1)
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(wrtclient.WRTException, wrtclient.check_outputs,
+                          ['echo a', 'sleep 10'], 0.5)
+        self.assertLess(time.time() - start, 5)
+
+    def test_failure(self):
+        self.assertRaises(subprocess.CalledProcessError, wrtclient.check_outputs,
+                          ['echo a', 'exit 3'], 5)
+
+
+class FakeTest(object):
+
+    def __init__(self, test_id):
+        self._id = test_id
+
+    def id(self):
+        return self._id
+
+
+class FakeResponse(object):
+
+    def __init__(self, data, status_code=200):
+        self.text = json.dumps(data)
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError('%s Error' % self.status_code)
+
+
+class FakeSession(object):
+    """Records the requests made, and answers them from `responses`,
+    {(method, url): data, a response, or function of the request's kwargs}."""
+
+    def __init__(self):
+        self.requests = []
+        self.responses = {}
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        data = self.responses.get((method, url), [])
+        if callable(data):
+            data = data(**kwargs)
+        if isinstance(data, FakeResponse):
+            return data
+        return FakeResponse(data)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+
+class TestWRTClientRequests(unittest2.TestCase):
+
+    concurrency = 4
+
+    def client(self, **kwargs):
+        stream = unittest2.runner._WritelnDecorator(StringIO.StringIO())
+        client = wrtclient.WRTClient('.wrt-sample-tests.conf', stream, **kwargs)
+        client.session = self.session = FakeSession()
+        client._project_url = 'http://server/api/projects/1/'
+        client._user_url = 'http://server/api/users/1/'
+        client._run_url = 'http://server/api/runs/7/'
+        self.session.responses[('POST', client.register_url)] = self.register
+        return client
+
+    def register(self, json):
+        return dict((name, {
+            'case_id': i, 'case_url': 'http://server/api/cases/%s/' % i,
+            'result_id': i, 'result_url': 'http://server/api/results/%s/' % i,
+        }) for i, name in enumerate(json['names']))
+
+    def requests(self, method):
+        return [(url, kwargs) for m, url, kwargs in self.session.requests
+                if m == method]
+
+    def test_register_in_one_request(self):
+        client = self.client()
+        tests = [FakeTest('test_%s' % i) for i in range(10)]
+        client.registerTests(tests)
+        posts = self.requests('POST')
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(posts[0][1]['json'],
+                         {'run': 7, 'names': [test.id() for test in tests]})
+        self.assertEqual(sorted(client._existing_tests),
+                         sorted(test.id() for test in tests))
+        # already registered, nothing more to send
+        client.registerTests(tests)
+        self.assertEqual(len(self.requests('POST')), 1)
+
+    def runTests(self, client, count):
+        tests = [FakeTest('test_%s' % i) for i in range(count)]
+        client.registerTests(tests)
+        for test in tests:
+            client.startTest(test, timestamp='2016-01-01T00:00:00')
+            client.markTestStatus(test, 'pass')
+            client.stopTest(test, timestamp='2016-01-01T00:00:01', duration=1.0)
+        client.close()
+
+    def test_coalesce(self):
+        self.runTests(self.client(coalesce=True), 3)
+        puts = self.requests('PUT')
+        self.assertEqual(len(puts), 6)
+        # the status goes with the end time
+        self.assertEqual(puts[1][1]['data']['status'], 'pass')
+        self.assertEqual(puts[1][1]['data']['end_time'], '2016-01-01T00:00:01')
+
+    def test_no_coalesce(self):
+        self.runTests(self.client(), 3)
+        self.assertEqual(len(self.requests('PUT')), 9)
+
+    def test_previous_run(self):
+        client = self.client()
+        client._tags = ['http://server/api/tags/3/', 'http://server/api/tags/5/']
+        self.session.responses[('GET', client.previous_run_url)] = {
+            'url': 'http://server/api/runs/6/'}
+        self.assertEqual(client.getPreviousTestRun(), 'http://server/api/runs/6/')
+        self.assertEqual(self.requests('GET'), [
+            (client.previous_run_url, {'params': {'project': 1, 'tags': [3, 5]}})])
+
+    def test_no_previous_run(self):
+        client = self.client()
+        client._tags = ['http://server/api/tags/3/']
+        self.session.responses[('GET', client.previous_run_url)] = FakeResponse(
+            {'detail': 'No matching run'}, status_code=404)
+        self.assertIsNone(client.getPreviousTestRun())
+
+    def test_failing(self):
+        client = self.client()
+        client._tags = ['http://server/api/tags/3/']
+        self.session.responses[('GET', client.previous_run_url)] = {
+            'url': 'http://server/api/runs/6/'}
+        self.session.responses[('GET', 'http://server/api/runs/6/failing/')] = [
+            'test_a', 'test_b']
+        self.assertEqual(client.failing(), ['test_a', 'test_b'])
+        self.assertEqual(self.requests('GET')[-1], (
+            'http://server/api/runs/6/failing/', {'params': {'exists': 1}}))
+
+    def test_failing_without_previous_run(self):
+        client = self.client()
+        client._tags = ['http://server/api/tags/3/']
+        self.session.responses[('GET', client.previous_run_url)] = FakeResponse(
+            {'detail': 'No matching run'}, status_code=404)
+        self.assertEqual(client.failing(), [])
+
+    def test_stale_cached_fixture(self):
+        client = self.client()
+        client.cache.set('fixtures', {'_Resource': 'http://server/api/cases/3/'})
+        client.registerTests([])
+
+        def start(data, **kwargs):
+            if data['case'] == 'http://server/api/cases/3/':
+                return FakeResponse({'case': ['Invalid hyperlink']}, status_code=400)
+            return {'url': 'http://server/api/results/5/'}
+        self.session.responses[('POST', client.results_url)] = start
+        self.session.responses[('POST', client.cases_url)] = {
+            'url': 'http://server/api/cases/4/'}
+        client.startFixture(FakeTest('_Resource'), '2016-01-01T00:00:00')
+        self.assertEqual(client._existing_fixtures['_Resource'],
+                         {'case_url': 'http://server/api/cases/4/'})
+        self.assertEqual(client.cache.get('fixtures'),
+                         {'_Resource': 'http://server/api/cases/4/'})
+        self.assertEqual(client._fixture_results,
+                         {'_Resource': 'http://server/api/results/5/'})
+
+    def test_threaded_fixtures(self):
+        # each worker thread makes its own, at the same time as the other
+        made = []
+        both = threading.Event()
+
+        class Local(ReportingTestResourceManager):
+
+            def make(self, dependency_resources):
+                made.append(self.use_id())
+                if len(made) == 2:
+                    both.set()
+                both.wait(5)
+                return object()
+
+        class Other(ReportingTestResourceManager):
+
+            def make(self, dependency_resources):
+                return object()
+
+        class Tests(ResourcedTestCase):
+
+            def test_a(self):
+                pass
+
+            def test_b(self):
+                pass
+
+        local = Local()
+        a, b = Tests('test_a'), Tests('test_b')
+        a.resources = [('local', local), ('other', Other())]
+        b.resources = [('local', local)]
+        result = WellRestedTestResult(verbosity=0, failing_file="", timings_file=None)
+        result.wrt_conf = '.wrt-sample-tests.conf'
+        result.wrt_client = client = self.client()
+        self.session.responses[('POST', client.cases_url)] = {
+            'url': 'http://server/api/cases/3/'}
+        results = itertools.count(100)
+        self.session.responses[('POST', client.results_url)] = lambda **kwargs: {
+            'url': 'http://server/api/results/%s/' % next(results)}
+        suite = ErrorTolerantOptimisedTestSuite(
+            [a, b], parallel=True, concurrency=2, threaded=True)
+        suite.run(result)
+        self.assertEqual(sorted(made), ['Creating_Local (1)', 'Creating_Local (2)'])
+        self.assertEqual(result.testsRun, 2)
+        self.assertEqual(result.warnings, [])
+        # each fixture result is stopped once, by the worker that started it
+        started = ['http://server/api/results/%s/' % i for i in range(100, next(results))]
+        stopped = [url for url, kwargs in self.requests('PUT')
+                   if 'end_time' in kwargs['data'] and url in started]
+        self.assertEqual(sorted(stopped), started)
+        self.assertEqual(client._fixture_results, {})
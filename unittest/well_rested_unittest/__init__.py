@@ -1,3 +1,4 @@
+import sys
 from result import *
 from runner import *
 from loader import *
@@ -16,6 +17,11 @@ def main():
 
 
 def wrt():
+    # `wrt replay <journal>` sends a journal written with --journal
+    if sys.argv[1:2] == ['replay']:
+        import replay
+        replay.main(sys.argv[2:])
+        return
     FullyConfigurableTestProgram(
         entry_settings={
             'verbosity': 2,
@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import tempfile
+
+__unittest = True
+
+
+class MetadataCache(object):
+    """
+    Remembers what WRTClient has looked up on the well-rested-tests server
+    (project url, user url, tag urls, case urls) from one run to the next,
+    so that a warm start needn't look any of it up again.
+
+    Entries are keyed by server, project and user, and are thrown away
+    once they are older than expire_seconds. A cache without a path
+    remembers things for the life of the object only.
+    """
+
+    version = 1
+
+    def __init__(self, path, key, expire_seconds=86400):
+        self.path = path
+        self.key = key
+        self.expire_seconds = expire_seconds
+        self.entry = self._load()
+        # whether anything came from the file, if so it might be stale
+        self.loaded = bool(self.entry)
+        if not self.entry:
+            self.invalidate()
+
+    def _read(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, 'rb') as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _load(self):
+        entry = self._read().get(self.key)
+        if not isinstance(entry, dict):
+            return {}
+        if entry.get('version') != self.version:
+            return {}
+        if time.time() - entry.get('created', 0) > self.expire_seconds:
+            return {}
+        return entry
+
+    def get(self, name, default=None):
+        return self.entry.get(name, default)
+
+    def set(self, name, value):
+        self.entry[name] = value
+
+    def update(self, name, mapping):
+        self.entry.setdefault(name, {}).update(mapping)
+
+    def invalidate(self):
+        self.entry = {'version': self.version, 'created': time.time()}
+        self.loaded = False
+
+    def save(self):
+        if not self.path:
+            return
+        # other processes may be using the same file for other keys
+        entries = self._read()
+        entries[self.key] = self.entry
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.wrt-cache')
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(entries, f)
+        # rename is atomic, so readers never see half a file
+        os.rename(temp, self.path)
+
+
+class Timings(object):
+    """
+    How long each test and fixture took the last time it ran, kept in a
+    file from one run to the next, so that parallel workers can be given
+    about the same amount of work (--schedule duration).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.durations = self._read()
+
+    def _read(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, 'rb') as f:
+                durations = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(durations, dict):
+            return {}
+        return durations
+
+    def __contains__(self, name):
+        return name in self.durations
+
+    def get(self, name, default=None):
+        return self.durations.get(name, default)
+
+    def save(self, durations):
+        """Add `durations` to those in the file, replacing older ones."""
+        if not self.path or not durations:
+            return
+        self.durations = self._read()
+        self.durations.update(durations)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.wrt-timings')
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(self.durations, f, sort_keys=True, indent=0)
+        os.rename(temp, self.path)
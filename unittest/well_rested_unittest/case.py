@@ -4,10 +4,12 @@ import fixtures
 import logging
 import time
 import os
+import sys
 import datetime
 from types import *  # noqa
 from unittest.util import safe_repr
 from testresources import setUpResources, tearDownResources, _get_result
+from suite import DetailCollector, ThreadLogger, ThreadStream
 
 __unittest = True
 
@@ -37,16 +39,19 @@ class ResourcedTestCase(testtools.TestCase, unittest2.TestCase):
         # test cases can have a logger too
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(self.log_level)
-        # capture logging
-        self.useFixture(fixtures.FakeLogger(format=self.log_format))
+        # capture logging, this thread's alone if tests run in threads
+        if isinstance(sys.stderr, ThreadStream):
+            self.useFixture(ThreadLogger(self.log_format))
+        else:
+            self.useFixture(fixtures.FakeLogger(format=self.log_format))
         # capture stderr
         if self._capture_error:
             stderr = self.useFixture(fixtures.StringStream('stderr')).stream
-            self.useFixture(fixtures.MonkeyPatch('sys.stderr', stderr))
+            self.useFixture(DetailCollector.redirect('stderr', stderr))
         # capture stdout
         if self._capture_output:
             stdout = self.useFixture(fixtures.StringStream('stdout')).stream
-            self.useFixture(fixtures.MonkeyPatch('sys.stdout', stdout))
+            self.useFixture(DetailCollector.redirect('stdout', stdout))
 
         testtools.TestCase.setUp(self)
 
@@ -0,0 +1,67 @@
+import os
+import json
+import base64
+import content
+
+__unittest = True
+
+
+class Journal(object):
+    """
+    An append-only record of what WRTClient sends, or would send, to the
+    well-rested-tests server, one JSON object per line, so that it can be
+    replayed later with `wrt replay`.
+
+    Each record is appended with a single write to a file opened O_APPEND,
+    so parallel workers can share one journal without mixing up lines.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.worker = os.getenv('WRT_WORKER_ID', None)
+
+    def record(self, event, **fields):
+        fields['event'] = event
+        if self.worker:
+            fields['worker'] = int(self.worker)
+        line = json.dumps(fields) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def read(path):
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # the writer was interrupted part way through
+                yield json.loads(line)
+
+
+def encode_details(details):
+    """Details as something json can write. They are read in the process."""
+    if not details:
+        return details
+    encoded = {}
+    for name, value in details.items():
+        encoded[name] = {
+            'type': value.content_type.type,
+            'subtype': value.content_type.subtype,
+            'parameters': value.content_type.parameters,
+            'bytes': base64.b64encode(''.join(value.iter_bytes())),
+        }
+    return encoded
+
+
+def decode_details(encoded):
+    if not encoded:
+        return encoded
+    details = {}
+    for name, value in encoded.items():
+        data = base64.b64decode(value['bytes'])
+        content_type = content.ContentType(
+            value['type'], value['subtype'], value['parameters'])
+        details[name] = content.Content(content_type, lambda data=data: [data])
+    return details
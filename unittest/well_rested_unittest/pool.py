@@ -0,0 +1,234 @@
+import os
+import sys
+import signal
+import json
+import shlex
+import shutil
+import argparse
+import tempfile
+import traceback
+from threading import Lock
+from records import WorkerProgress, write_record, heartbeat_interval
+
+__unittest = True
+
+
+class WorkerPool(object):
+    """
+    Workers forked from this process, which has already imported and
+    discovered the tests, to run them in parallel. Each worker waits on
+    a pipe for batches of test ids, runs them as `wrtest` would, and sends
+    its results back on another pipe as it goes, then says it's done.
+    A third pipe tells it to stop early.
+
+    Workers are numbered from 1, and last until close(), unless one dies
+    or, given a timeout, gets stuck, when a new one takes its place.
+    By then there are threads about, and a process forked from one with
+    threads can wait forever on a lock another of them held. So new
+    workers are forked by a helper process, forked before any of them,
+    and talk to the parent over named pipes.
+    """
+
+    def __init__(self, tests, suite_class, result_class, progName, debug=0,
+                 setup_threads=1, timeout=0):
+        self.tests = dict((test.id(), test) for test in tests)
+        self.suite_class = suite_class
+        self.result_class = result_class
+        self.progName = progName
+        self.debug = debug
+        self.setup_threads = setup_threads
+        self.timeout = timeout
+        self.workers = {}  # number -> (pid, to worker, from worker, stop fd)
+        self.lock = Lock()
+        self.forker = None  # (pid, to forker, from forker)
+        self.adopted = set()  # pids of the workers the helper forked
+
+    def start(self, count):
+        with self.lock:
+            self.forker = self._startForker()
+        for worker in range(1, count + 1):
+            self.worker(worker)
+
+    def worker(self, number):
+        with self.lock:
+            if number in self.workers:
+                return self.workers[number]
+        worker = self._forkFromForker(number)
+        with self.lock:
+            self.workers[number] = worker
+        return worker
+
+    def _startForker(self):
+        requests_r, requests_w = os.pipe()
+        pids_r, pids_w = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            os.close(requests_r)
+            os.close(pids_w)
+            return (pid, os.fdopen(requests_w, 'wb', 0), os.fdopen(pids_r, 'rb', 0))
+        # the helper, with no threads, forks a worker for each request
+        status = 0
+        try:
+            os.close(requests_w)
+            os.close(pids_r)
+            # it doesn't wait for them, so they needn't wait for it
+            signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+            requests = os.fdopen(requests_r, 'rb', 0)
+            pids = os.fdopen(pids_w, 'wb', 0)
+            for line in iter(requests.readline, ''):
+                request = json.loads(line)
+                pid = os.fork()
+                if not pid:
+                    requests.close()
+                    pids.close()
+                    self._adopt(request['number'], request['fifos'])
+                pids.write('%s\n' % pid)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _adopt(self, number, fifos):
+        """Serve as worker `number`, over the named pipes `fifos`."""
+        status = 0
+        try:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # opened in the same order as the parent opens them
+            batches = open(fifos[0], 'rb', 0)
+            done = open(fifos[1], 'wb', 0)
+            stop = os.open(fifos[2], os.O_RDONLY)
+            self._serve(number, batches, done, stop)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _forkFromForker(self, number):
+        pid, to_forker, from_forker = self.forker
+        directory = tempfile.mkdtemp(prefix='wrt-worker%s-' % number)
+        try:
+            fifos = [os.path.join(directory, name)
+                     for name in ('batches', 'done', 'stop')]
+            for fifo in fifos:
+                os.mkfifo(fifo, 0600)
+            # one request at a time, so each gets its own pid back
+            with self.lock:
+                to_forker.write(json.dumps({'number': number, 'fifos': fifos}) + '\n')
+                pid = int(from_forker.readline())
+                self.adopted.add(pid)
+            # each open waits for the worker to open the other end,
+            # which mustn't hold up the other workers meanwhile
+            to_worker = open(fifos[0], 'wb', 0)
+            from_worker = open(fifos[1], 'rb', 0)
+            stop_worker = os.open(fifos[2], os.O_WRONLY)
+        finally:
+            shutil.rmtree(directory)
+        return (pid, to_worker, from_worker, stop_worker)
+
+    def _serve(self, number, batches, done, stop):
+        from runner import OutputDelegatingTestRunner
+        os.environ['WRT_WORKER_ID'] = str(number)
+        os.environ['WRT_STREAM_FD'] = str(done.fileno())
+        os.environ['WRT_CONTROL_FD'] = str(stop)
+        if self.timeout:
+            os.environ['WRT_HEARTBEAT'] = str(heartbeat_interval(self.timeout))
+        # one suite for all the batches, so resources can outlast a batch
+        suite = self.suite_class([], debug=self.debug,
+                                 setup_threads=self.setup_threads)
+        for line in iter(batches.readline, ''):
+            batch = json.loads(line)
+            if batch['handoff']:
+                os.environ['WRT_HANDOFF'] = batch['handoff']
+            result = self.workerResult(batch['flags'])
+            suite._tests = [self.tests[test_id] for test_id in batch['ids']]
+            suite.keep_resources = batch['keep']
+            try:
+                OutputDelegatingTestRunner(result=result).run(suite)
+            except SystemExit:  # how the runner says it was interrupted
+                pass
+            write_record(done.fileno(), {'done': True})
+
+    def workerResult(self, flags):
+        """A result like the one `wrtest <flags>` would make."""
+        parser = argparse.ArgumentParser()
+        self.result_class.parserOptions(parser)
+        args = parser.parse_args(shlex.split(' '.join(flags)))
+        args.progName = self.progName
+        args.debug = self.debug
+        return self.result_class.factory(self.result_class, args)
+
+    def run(self, number, test_ids, result, keep=False):
+        """
+        Run the tests in worker `number`, and absorb its results.
+        If the worker dies, the tests it didn't start are run again
+        in a new worker.
+
+        :param keep: leave the resources set up for the next batch
+        """
+        progress = WorkerProgress()
+        pid, to_worker, from_worker, stop_worker = self.worker(number)
+        batch = {
+            'ids': test_ids,
+            'keep': keep,
+            'flags': result.worker_flags(),
+            'handoff': result.handoff(),
+        }
+        if self.debug:
+            result.stream.writeln('worker %s: %s tests' % (number, len(test_ids)))
+        try:
+            to_worker.write(json.dumps(batch) + '\n')
+        except IOError:  # it died after its last batch, which shows below
+            pass
+        result.addControl(stop_worker)
+        try:
+            if progress.absorb(result, from_worker.fileno(), self.timeout):
+                return
+        finally:
+            result.removeControl(stop_worker)
+        self.discard(number)
+        test_ids = progress.unfinished(result, number, test_ids)
+        if test_ids and not result.shouldStop:
+            self.run(number, test_ids, result, keep)
+
+    def discard(self, number):
+        """Kill worker `number`, if it isn't dead already."""
+        with self.lock:
+            pid, to_worker, from_worker, stop_worker = self.workers.pop(number)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        to_worker.close()
+        from_worker.close()
+        os.close(stop_worker)
+        self._wait(pid)
+
+    def _wait(self, pid, from_worker=None):
+        if pid not in self.adopted:
+            os.waitpid(pid, 0)
+        elif from_worker:
+            # the helper reaps it, it's gone once its end of the pipe is
+            for data in iter(lambda: from_worker.read(8192), ''):
+                pass
+        self.adopted.discard(pid)
+
+    def close(self):
+        """Tell the workers there's nothing more to do, and wait for them."""
+        with self.lock:
+            for pid, to_worker, from_worker, stop_worker in self.workers.values():
+                to_worker.close()
+            for pid, to_worker, from_worker, stop_worker in self.workers.values():
+                self._wait(pid, from_worker)
+                from_worker.close()
+                os.close(stop_worker)
+            self.workers = {}
+            if self.forker:
+                pid, to_forker, from_forker = self.forker
+                to_forker.close()
+                from_forker.close()
+                os.waitpid(pid, 0)
+                self.forker = None
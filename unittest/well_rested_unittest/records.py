@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import select
+import struct
+from threading import Lock, Thread
+
+__unittest = True
+
+# each record is its length, then that much json
+HEADER = struct.Struct('>I')
+
+# the heartbeat is written from a thread of its own
+_writeLock = Lock()
+_heart = None
+
+
+def write_record(fd, record):
+    """Write record to the file descriptor fd."""
+    payload = json.dumps(record)
+    data = HEADER.pack(len(payload)) + payload
+    with _writeLock:
+        while data:
+            data = data[os.write(fd, data):]
+
+
+def heartbeat_interval(timeout):
+    """How often a worker sends a heartbeat, given the parent's timeout."""
+    return timeout / 4.0
+
+
+def start_heartbeat(fd, interval):
+    """
+    Send a heartbeat record on fd every interval seconds, from a thread,
+    so the parent can tell a worker that has stopped responding from one
+    that's stuck in a test. Once per process.
+    """
+    global _heart
+
+    def beat():
+        try:
+            while True:
+                time.sleep(interval)
+                write_record(fd, {'heartbeat': True})
+        except OSError:  # the parent has gone
+            pass
+
+    with _writeLock:
+        if _heart is None:
+            _heart = Thread(target=beat)
+            _heart.daemon = True
+            _heart.start()
+
+
+def _read(fd, size):
+    data = ''
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_record(fd):
+    """
+    Read the next record from the file descriptor fd.
+
+    :return: the record, or None once the writer has gone (a record it
+             was part way through writing is dropped)
+    """
+    header = _read(fd, HEADER.size)
+    if header is None:
+        return None
+    length, = HEADER.unpack(header)
+    payload = _read(fd, length)
+    if payload is None:
+        return None
+    return json.loads(payload)
+
+
+class WorkerProgress(object):
+    """What a parent has heard from a worker about the tests it started."""
+
+    def __init__(self):
+        self.started = set()
+        self.running = None
+        self.finished = False
+        self.timed_out = False
+        self.responding = True
+
+    def absorb(self, result, fd, timeout=0):
+        """
+        Absorb the records a worker sends on fd into result, until it says
+        it's done, goes away or, given a timeout, goes that many seconds
+        without starting or stopping a test or fixture, each of which sends
+        a record. Heartbeats aren't progress, they only show whether the
+        worker is stuck in a test or has stopped responding altogether.
+
+        :return: True if the worker finished
+        """
+        progress = heard = time.time()
+        while True:
+            if timeout:
+                wait = progress + timeout - time.time()
+                if wait <= 0 or not select.select([fd], [], [], wait)[0]:
+                    self.timed_out = True
+                    # allowing it a missed heartbeat
+                    self.responding = (
+                        time.time() - heard < 2 * heartbeat_interval(timeout))
+                    return False
+            record = read_record(fd)
+            if record is None:
+                return self.finished
+            heard = time.time()
+            if record.get('heartbeat'):
+                continue
+            progress = heard
+            if record.get('done'):
+                return True
+            if 'started' in record:
+                self.started.add(record['started'])
+                self.running = record['started']
+            if 'stopped' in record:
+                self.running = None
+            if record.get('finished'):
+                self.finished = True
+            result.absorbRecord(record)
+
+    def unfinished(self, result, worker, test_ids):
+        """
+        Report the test the worker was running when it died as aborted.
+
+        :return: the ids of the tests it never started, to run elsewhere
+        """
+        why = 'exited'
+        if self.timed_out:
+            why = 'timed out' if self.responding else 'stopped responding'
+        if self.running:
+            result.addAborted(
+                self.running, 'Worker %s %s while running this test' % (worker, why))
+        elif not self.started:
+            # it would only do the same again
+            with result.absorbLock:
+                result.errors.append(
+                    ('Worker %s' % worker, '%s before finishing its tests' % why))
+            return []
+        return [test_id for test_id in test_ids if test_id not in self.started]
@@ -0,0 +1,123 @@
+import os
+import sys
+import argparse
+import tempfile
+import unittest2
+import wrtclient
+from journal import Journal, decode_details
+
+__unittest = True
+
+
+class _Recorded(object):
+    """Stands in for the test or fixture a journal record is about."""
+
+    def __init__(self, test_id, use_id=None):
+        self._id = test_id
+        self._use_id = use_id or test_id
+
+    def id(self):
+        return self._id
+
+    def use_id(self):
+        return self._use_id
+
+
+def _worker_client(parent, wrt_conf, stream, debug):
+    # the same hand off parallel workers get from their parent
+    fd, handoff = tempfile.mkstemp(prefix='.wrt-handoff')
+    os.close(fd)
+    try:
+        parent.dumpState(handoff)
+        client = wrtclient.WRTClient(
+            wrt_conf, stream, debug=debug, run_url=parent._run_url)
+        client.loadState(handoff)
+    finally:
+        os.remove(handoff)
+    return client
+
+
+def replay(path, wrt_conf, stream, debug=False, force=False):
+    """
+    Send every run recorded in the journal at `path` to the
+    well-rested-tests server.
+
+    Records from parallel workers are sent by one client per worker,
+    as they were when the tests ran.
+
+    :param force: replay runs that were sent live as they were recorded
+        too, which registers them twice
+    :return: list of the urls of the runs replayed
+    """
+    # before anything is sent, so it's all or nothing
+    live = [record['timestamp'] for record in Journal.read(path)
+            if record['event'] == 'startTestRun' and not record.get('offline')]
+    if live and not force:
+        raise wrtclient.WRTException(
+            '%s: the run(s) started at %s were sent to the server as they '
+            'were recorded, replaying them would register them twice'
+            % (path, ', '.join(map(str, live))))
+    run_urls = []
+    clients = {}
+    for record in Journal.read(path):
+        event = record.pop('event')
+        worker = record.pop('worker', None)
+        if event == 'startTestRun':
+            parent = wrtclient.WRTClient(
+                wrt_conf, stream, debug=debug, run_url=record['run_url'],
+                tag_values=record['tags'])
+            parent.startTestRun(timestamp=record['timestamp'])
+            clients = {None: parent}
+            run_urls.append(parent._run_url)
+            continue
+        if not clients:
+            raise wrtclient.WRTException(
+                '%s: %s recorded before startTestRun' % (path, event))
+        if worker not in clients:
+            clients[worker] = _worker_client(clients[None], wrt_conf, stream, debug)
+        client = clients[worker]
+        if event == 'registerTests':
+            client.registerTests([_Recorded(name) for name in record['names']])
+        elif event == 'stopTestRun':
+            for client in clients.values():
+                client.close()
+            clients[None].stopTestRun(
+                timestamp=record['timestamp'], **record['kwargs'])
+            clients = {}
+        else:
+            kwargs = record['kwargs']
+            if 'details' in kwargs:
+                kwargs['details'] = decode_details(kwargs['details'])
+            getattr(client, event)(_Recorded(record['id'], record.get('use_id')),
+                                   *record['args'], **kwargs)
+    # a run that was interrupted never recorded stopTestRun
+    for client in clients.values():
+        client.close()
+    return run_urls
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='wrt replay',
+        description='Send a journal written with --journal to the '
+                    'well-rested-tests server.')
+    parser.add_argument('journal', help='Path to the journal.')
+    parser.add_argument('-w', '--wrt-conf', dest='wrt_conf', default='.wrt.conf',
+                        help='Path to well-rested-tests config file. '
+                             'See .wrt.conf.template')
+    parser.add_argument('--keep', dest='keep', action='store_true',
+                        help='Keep the journal once it has been sent (default False).')
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help='Replay runs that were recorded without --offline, '
+                             'so were sent as they ran, a second time '
+                             '(default False).')
+    parser.add_argument('--debug', dest='debug', action='store_true',
+                        help='Print what is sent (default False).')
+    args = parser.parse_args(argv)
+    stream = unittest2.runner._WritelnDecorator(sys.stderr)
+    for run_url in replay(args.journal, args.wrt_conf, stream, debug=args.debug,
+                          force=args.force):
+        stream.writeln('Replayed %s' % run_url)
+    # so the same runs aren't sent twice
+    if not args.keep:
+        os.remove(args.journal)
@@ -8,10 +8,12 @@ import datetime
 import wrtclient
 import json
 import shutil
-from threading import Lock
+from threading import Lock, RLock, Thread, local
 import content
 import ConfigParser
 from exceptions import SwiftConfNotFound
+from cache import Timings
+from records import write_record, start_heartbeat
 
 try:
     from blessings import Terminal
@@ -21,6 +23,16 @@ except ImportError:
 __unittest = True
 
 
+class _Aborted(object):
+    """Stands in for the test a parallel worker was running when it died."""
+
+    def __init__(self, test_id):
+        self._id = test_id
+
+    def id(self):
+        return self._id
+
+
 class ColorizedWritelnDecorator(object):
     """Used to decorate file-like objects with a handy 'writeln' method"""
     def __init__(self, stream):
@@ -117,6 +129,24 @@ class WellRestedTestResult(
         group.add_argument('--store-pass', dest='store_pass', action='store_true',
                            help='Store (with --storage) or display (with -e) details'
                                 ' for passing tests (default False).')
+        group.add_argument('--upload-queue', dest='upload_queue', type=int, default=0,
+                           help='Send test updates to the well-rested-tests server from '
+                                'a background thread, queueing up to this many '
+                                '(default 0, send immediately).')
+        group.add_argument('--coalesce', dest='coalesce', action='store_true',
+                           help="Send each test's status and end time to the "
+                                "well-rested-tests server as one update (default False).")
+        group.add_argument('--journal', dest='journal', default=None,
+                           help='Also record test updates in this file, to be sent '
+                                'later with `wrt replay` (default None).')
+        group.add_argument('--offline', dest='offline', action='store_true',
+                           help='Only record test updates in the --journal '
+                                '(default .wrt-journal), don\'t send them '
+                                'to the well-rested-tests server (default False).')
+        group.add_argument('--timings-file', dest='timings_file', default=None,
+                           help='Keep how long each test and fixture took in this '
+                                'file (default None). With --schedule duration, '
+                                'they are kept in .wrt-timings unless this is given.')
         return parser
 
     @staticmethod
@@ -140,6 +170,15 @@ class WellRestedTestResult(
             storage=object.storage if hasattr(object, 'storage') else None,
             store_pass=object.store_pass if hasattr(object, 'store_pass') else False,
             debug=object.debug if hasattr(object, 'debug') else 0,
+            upload_queue=object.upload_queue if hasattr(object, 'upload_queue') else 0,
+            coalesce=object.coalesce if hasattr(object, 'coalesce') else False,
+            journal=object.journal if hasattr(object, 'journal') else None,
+            offline=object.offline if hasattr(object, 'offline') else False,
+            # only kept when asked for, or needed by --schedule duration
+            timings_file=(object.timings_file if
+                hasattr(object, 'timings_file') else None) or (
+                '.wrt-timings' if hasattr(object, 'schedule') and
+                object.schedule == 'duration' else None),
         )
 
     @staticmethod
@@ -169,6 +208,21 @@ class WellRestedTestResult(
   --storage STORAGE     Path at which to store details.
   --store-pass          Store (with --storage) or display (with -e) details
                         for passing tests (default False).
+  --upload-queue UPLOAD_QUEUE
+                        Send test updates to the well-rested-tests server from
+                        a background thread, queueing up to this many (default
+                        0, send immediately).
+  --coalesce            Send each test's status and end time to the well-
+                        rested-tests server as one update (default False).
+  --journal JOURNAL     Also record test updates in this file, to be sent
+                        later with `wrt replay` (default None).
+  --offline             Only record test updates in the --journal (default
+                        .wrt-journal), don't send them to the well-rested-
+                        tests server (default False).
+  --timings-file TIMINGS_FILE
+                        Keep how long each test and fixture took in this file
+                        (default None). With --schedule duration, they are
+                        kept in .wrt-timings unless this is given.
 """ % cls.__name__
 
     def __init__(self, failfast=False,
@@ -176,7 +230,9 @@ class WellRestedTestResult(
                  failing_file='.failing',
                  wrt_conf=None, swift_conf=None, progName=None, color=False,
                  update=False, failing=False, timestamp=False, run_url=None,
-                 fail_percent=0, storage=None, store_pass=False, debug=0):
+                 fail_percent=0, storage=None, store_pass=False, debug=0,
+                 upload_queue=0, coalesce=False, journal=None, offline=False,
+                 timings_file=None):
         """
         :param failfast: boolean (default False)
         :param uxsuccess_not_failure: boolean (default False)
@@ -195,6 +251,14 @@ class WellRestedTestResult(
         :param storage:  Path at which to store details
         :param store_pass: boolean (default False) display or store details for passing tests
         :param debug:    debug > 1 causes debug printing in wrtconf
+        :param upload_queue: number of test updates which may be waiting
+                             to be sent to the server (default 0, no waiting)
+        :param coalesce: boolean (default False) send status with the stop update
+        :param journal:  path of a file to record test updates in for `wrt replay`
+        :param offline:  boolean (default False) only record test updates
+                         in the journal (default .wrt-journal)
+        :param timings_file: path of a file to keep test and fixture durations in
+                             (default None, not kept)
         :return:
         """
         # some initial processing
@@ -224,15 +288,38 @@ class WellRestedTestResult(
         self.test_start_time = {}
         self.test_end_time = {}
         self.test_result = {}
-        self._detail = ""
+        # tests run in threads each have details of their own to print
+        self._local = local()
+        # held while tests run in threads (--threaded) change the result,
+        # but not while they talk to the server
+        self.reportLock = RLock()
+        self.swiftLock = Lock()
         self._test_run = None
         self.wrt_conf = None
         self.wrt_client = None
         self.swift_conf = None
         self.swift_config = None
+        self.swift_compression = None
         self.progName = progName
         self.absorbLock = Lock()
         self._expected_tests = 0
+        self.handoff_file = '.wrt-handoff'
+        self._handoff_written = False
+        self.upload_queue = upload_queue
+        self.coalesce = coalesce
+        self.offline = offline
+        if self.offline and not journal:
+            journal = '.wrt-journal'
+        self.journal = journal
+        self.timings_file = timings_file
+        self.durations = {}
+        # a worker sends its results to the parent as they come, if it's listening
+        self.stream_fd = None
+        self._streamed = {}
+        self._failing = []
+        # pipes on which to tell parallel workers to stop
+        self.controls = set()
+        self.controlLock = Lock()
 
         # super
         unittest2.TextTestResult.__init__(self, self.stream, False, verbosity)
@@ -247,6 +334,12 @@ class WellRestedTestResult(
         # worker (ie, parallel) set color and failing_file
         if self.worker:
             self.worker = int(self.worker)
+            if os.getenv('WRT_STREAM_FD'):
+                self.stream_fd = int(os.getenv('WRT_STREAM_FD'))
+                if os.getenv('WRT_HEARTBEAT'):
+                    start_heartbeat(self.stream_fd, float(os.getenv('WRT_HEARTBEAT')))
+            if os.getenv('WRT_CONTROL_FD'):
+                self.listenForStop(int(os.getenv('WRT_CONTROL_FD')))
             if self.color:
                 self.stream.set_color(self.worker)
             if failing_file:
@@ -262,7 +355,9 @@ class WellRestedTestResult(
         if wrt_conf:
             self.wrt_conf = wrt_conf
             self.wrt_client = wrtclient.WRTClient(
-                wrt_conf, self.stream, debug=debug > 1, run_url=run_url)
+                wrt_conf, self.stream, debug=debug > 1, run_url=run_url,
+                upload_queue=upload_queue, coalesce=coalesce,
+                journal=journal, offline=offline)
             if self.storage:
                 sys.stderr.write('\nWarning: details stored locally cannot be uploaded to'
                                  'well-rested-tests server.\n')
@@ -286,6 +381,65 @@ class WellRestedTestResult(
             self.object_headers = {}
             if expire:
                 self.object_headers['X-Delete-After'] = expire
+            # optionally compress text, swift hands it back with Content-Encoding
+            try:
+                self.swift_compression = self.swift_config.get('swift', 'COMPRESSION')
+            except ConfigParser.Error:
+                pass
+
+    # in a worker, the result the parent's stop is for (see listenForStop)
+    _listenLock = Lock()
+    _listener = None
+    _listening = None
+    _stopRequested = False
+
+    def listenForStop(self, fd):
+        """
+        Stop when the parent writes to (or closes) the pipe fd. A forked
+        worker has a result per batch, all listening on the same pipe.
+        """
+        cls = self.__class__
+        with cls._listenLock:
+            cls._listening = self
+            if cls._stopRequested:
+                self.stop()
+            if cls._listener is None:
+                cls._listener = Thread(target=cls._waitForStop, args=(fd,))
+                cls._listener.daemon = True
+                cls._listener.start()
+
+    @classmethod
+    def _waitForStop(cls, fd):
+        os.read(fd, 1)
+        with cls._listenLock:
+            cls._stopRequested = True
+            if cls._listening:
+                cls._listening.stop()
+
+    def addControl(self, fd):
+        """Tell the worker listening on the other end of fd when to stop."""
+        with self.controlLock:
+            self.controls.add(fd)
+            if self.shouldStop:
+                self._tellStop(fd)
+
+    def removeControl(self, fd):
+        with self.controlLock:
+            self.controls.discard(fd)
+
+    @staticmethod
+    def _tellStop(fd):
+        try:
+            os.write(fd, 'stop\n')
+        except OSError:  # it's already finished
+            pass
+
+    def stop(self):
+        """Stop, and tell any parallel workers to."""
+        testtools.TestResult.stop(self)
+        with self.controlLock:
+            for fd in self.controls:
+                self._tellStop(fd)
 
     def worker_flags(self):
         """The suite shouldn't need to know what the flags are."""
@@ -309,9 +463,10 @@ class WellRestedTestResult(
         if self.fail_percent:
             flags.append('-a %s' % self.fail_percent)
         if self.wrt_conf:
-            flags.extend([
-                '--wrt-conf %s' % self.wrt_conf,
-                '--run-url %s' % self.wrt_client._run_url])
+            flags.append('--wrt-conf %s' % self.wrt_conf)
+            # offline, there is no run yet
+            if self.wrt_client._run_url:
+                flags.append('--run-url %s' % self.wrt_client._run_url)
         if self.swift_conf:
             flags.extend([
                 '--swift-conf %s' % self.swift_conf,
@@ -321,6 +476,14 @@ class WellRestedTestResult(
             flags.append('--storage %s' % self.storage)
         if self.store_pass:
             flags.append('--store-pass')
+        if self.upload_queue:
+            flags.append('--upload-queue %s' % self.upload_queue)
+        if self.coalesce:
+            flags.append('--coalesce')
+        if self.journal:
+            flags.append('--journal %s' % self.journal)
+        if self.offline:
+            flags.append('--offline')
         return flags
 
     @staticmethod
@@ -386,8 +549,15 @@ class WellRestedTestResult(
                                 details[name] = content.unittest_traceback_content(sys.exc_info())
                         details[name] = content.url_content('file://%s' % path)
                     elif self.swift:
-                        self.swift.put_object(self.container, filename, attachment,
-                                              headers=self.object_headers)
+                        headers = self.object_headers
+                        if self.swift_compression == 'gzip' and \
+                                value.content_type.type == 'text':
+                            attachment = ''.join(wrtclient.gzipped(
+                                [attachment.encode('utf8')]))
+                            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+                        with self.swiftLock:
+                            self.swift.put_object(self.container, filename,
+                                                  attachment, headers=headers)
                         url = '%s/%s/%s' % (self.swift.url, self.container, filename)
                         details[name] = content.url_content(url)
         return details
@@ -397,10 +567,11 @@ class WellRestedTestResult(
         if details:
             if 'reason' in details:
                 reason = details.pop('reason').as_text()
-            if reason not in self.reasons:
-                self.reasons[reason] = 1
-            else:
-                self.reasons[reason] += 1
+            with self.reportLock:
+                if reason not in self.reasons:
+                    self.reasons[reason] = 1
+                else:
+                    self.reasons[reason] += 1
         return reason
 
     def format_time(self, timestamp):
@@ -413,9 +584,25 @@ class WellRestedTestResult(
     def registerTests(self, tests):
         filtered_tests = [test for test in tests
                           if isinstance(test, unittest2.TestCase)]
-        self._expected_tests = len(filtered_tests)
+        self._expected_tests += len(filtered_tests)
         if self.wrt_conf:
             self.wrt_client.registerTests(filtered_tests)
+            self._handoff_written = False
+
+    def handoff(self):
+        """
+        Write what the wrt_client has looked up and registered to a file
+        which workers can load instead of doing it all again.
+
+        :return: path of the file, or None if there's nothing to hand off
+        """
+        if not self.wrt_client or self.worker or self.offline:
+            return None
+        with self.absorbLock:
+            if not self._handoff_written:
+                self.wrt_client.dumpState(self.handoff_file)
+                self._handoff_written = True
+        return self.handoff_file
 
     def startTestRun(self):
         if not self.start_time:  # may have been passed in in --run-url
@@ -437,7 +624,7 @@ class WellRestedTestResult(
             else:
                 fh = open(self.failing_file, 'wb')
             self.failing_fh = unittest2.runner._WritelnDecorator(fh)
-        if self.showAll and self.wrt_client and not self.worker:
+        if self.showAll and self.run_url and not self.worker:
             self.stream.writeln("Watch progress at: %s" % self.run_url)
             self.stream.writeln(self.separator2)
         unittest2.TextTestResult.startTestRun(self)
@@ -482,11 +669,18 @@ class WellRestedTestResult(
             status='pass'
         else:
             status='fail'
+        if self.wrt_client:
+            self.wrt_client.close()
         if self.wrt_client and not self.worker:
             self.wrt_client.stopTestRun(
                 timestamp=self.format_time(self.end_time),
                 status=status)
         testtools.TestResult.stopTestRun(self)
+        if self._handoff_written:
+            os.remove(self.handoff_file)
+            self._handoff_written = False
+        if self.timings_file and not self.worker:
+            Timings(self.timings_file).save(self.durations)
         if self.failing_file:
             self.failing_fh.close()
             if status == 'aborted' and not self.worker:
@@ -495,7 +689,9 @@ class WellRestedTestResult(
                         shutil.copyfileobj(src, self.failing_file)
                 except IOError:
                     pass
-        if self.worker:
+        if self.stream_fd is not None:
+            self.streamResults(durations=self.durations, finished=True)
+        elif self.worker:
             output = json.dumps({
                 'duration': elapsed_time,
                 'failures': self.failures,
@@ -509,6 +705,7 @@ class WellRestedTestResult(
                 'fixtures': self.fixtures,
                 'worker': self.worker,
                 'reasons': self.reasons,
+                'durations': self.durations,
             }, sort_keys=True, indent=4, separators=(',', ': '))
             with open('.worker%s' % self.worker, 'wb') as f:
                 f.write(output + '\n')
@@ -516,34 +713,66 @@ class WellRestedTestResult(
                 self.printErrors()
                 self.printSummary()
 
-    def absorbResult(self, stdout):
-        with self.absorbLock:
-            try:
-                other_result = json.loads(stdout)
-            except ValueError:
-                self.stream.writeln(stdout)
-                raise
-            self.failures.extend(other_result['failures'])
-            self.errors.extend(other_result['errors'])
-            self.skipped.extend(other_result['skipped'])
-            self.unexpectedSuccesses.extend(other_result['unexpectedSuccesses'])
-            self.expectedFailures.extend(other_result['expectedFailures'])
-            self.infos.extend(other_result['infos'])
-            self.warnings.extend(other_result['warnings'])
-            self.testsRun += other_result['testsRun']
-            self.fixtures += other_result['fixtures']
+    # what a worker's results are made of
+    _result_lists = ('failures', 'errors', 'skipped', 'unexpectedSuccesses',
+                     'expectedFailures', 'infos', 'warnings')
+    _result_counts = ('testsRun', 'fixtures')
+
+    def streamResults(self, **extra):
+        """Send the parent whatever has happened since last time."""
+        record = dict(extra)
+        for name in self._result_lists + self._result_counts:
+            value = getattr(self, name)
+            sent = self._streamed.get(name, 0)
+            if isinstance(value, list):
+                if len(value) > sent:
+                    record[name] = value[sent:]
+                self._streamed[name] = len(value)
+            else:
+                if value > sent:
+                    record[name] = value - sent
+                self._streamed[name] = value
+        sent = self._streamed.setdefault('reasons', {})
+        reasons = dict((reason, count - sent.get(reason, 0))
+                       for reason, count in self.reasons.items()
+                       if count > sent.get(reason, 0))
+        if reasons:
+            record['reasons'] = reasons
+            sent.update(self.reasons)
+        if self._failing:
+            record['failing'] = self._failing
+            self._failing = []
+        if record:
+            write_record(self.stream_fd, record)
+
+    def absorbRecord(self, other_result):
+        """Merge in all or part of a worker's results."""
+        # reportLock too, as the parent reports aborted tests itself
+        with self.absorbLock, self.reportLock:
+            for name in self._result_lists:
+                getattr(self, name).extend(other_result.get(name, []))
+            self.testsRun += other_result.get('testsRun', 0)
+            self.fixtures += other_result.get('fixtures', 0)
+            self.durations.update(other_result.get('durations', {}))
+            reasons = other_result.get('reasons', {})
             # json changed None to null, change it back
             null = other_result.pop('null', None)
             if null:
-                other_result['reasons'][None] = null
-            for reason in other_result['reasons']:
+                reasons[None] = null
+            for reason in reasons:
                 if reason in self.reasons:
-                    self.reasons[reason] += other_result['reasons'][reason]
+                    self.reasons[reason] += reasons[reason]
                 else:
-                    self.reasons[reason] = other_result['reasons'][reason]
+                    self.reasons[reason] = reasons[reason]
             if self.failing_file:
-                with open('.failing%s' % other_result['worker']) as src:
-                    self.failing_fh.write(src.read())
+                for test_id in other_result.get('failing', []):
+                    self.failing_fh.writeln(test_id)
+            # stop handing out tests, as a single process would
+            if self.failfast and (other_result.get('failures') or
+                                  other_result.get('errors')):
+                self.stop()
+            elif self._tooManyFixtureFailures():
+                self.stop()
 
     # test related methods
     def getDescription(self, test):
@@ -554,38 +783,53 @@ class WellRestedTestResult(
         output = output + (test.id() if hasattr(test, 'id') else str(test))
         return output
 
+    @property
+    def _detail(self):
+        return getattr(self._local, 'detail', '')
+
+    @_detail.setter
+    def _detail(self, detail):
+        self._local.detail = detail
+
     def startTest(self, test):
         if not isinstance(test, unittest2.TestCase):
             return
-        self.test_start_time[test.id()] = time.time()
+        start_time = time.time()
         if self.wrt_client:
-            self.wrt_client.startTest(
-                test, timestamp=self.format_time(self.test_start_time[test.id()]))
-        if self.showAll:
-            if self.timestamp:
-                self.stream.write(self.format_time(self.test_start_time[test.id()]) + ' ')
-            self.stream.write('%s ... ' % self.getDescription(test))
-        unittest2.TestResult.startTest(self, test)
+            self.wrt_client.startTest(test, timestamp=self.format_time(start_time))
+        with self.reportLock:
+            self.test_start_time[test.id()] = start_time
+            if self.showAll:
+                if self.timestamp:
+                    self.stream.write(self.format_time(start_time) + ' ')
+                self.stream.write('%s ... ' % self.getDescription(test))
+            unittest2.TestResult.startTest(self, test)
+            if self.stream_fd is not None:
+                self.streamResults(started=test.id())
 
     def stopTest(self, test):
         """also print out test duration"""
         if not isinstance(test, unittest2.TestCase):
             return
-        self.test_end_time[test.id()] = time.time()
-        elapsed_time = self.test_end_time[test.id()] - self.test_start_time[test.id()]
-        if self.showAll:
-            self.stream.writeln(" in %.3f" % elapsed_time)
-        if self.early_details:
-            if self._detail:
-                self.stream.writeln(self.separator1)
-                self.stream.writeln(self._detail)
-                self.stream.writeln(self.separator2)
-                self._detail = ""
+        end_time = time.time()
+        elapsed_time = end_time - self.test_start_time[test.id()]
         if self.wrt_client:
             self.wrt_client.stopTest(
-                test, timestamp=self.format_time(self.test_end_time[test.id()]),
-                duration=elapsed_time)
-        unittest2.TestResult.stopTest(self, test)
+                test, timestamp=self.format_time(end_time), duration=elapsed_time)
+        with self.reportLock:
+            self.test_end_time[test.id()] = end_time
+            self.durations[test.id()] = elapsed_time
+            if self.showAll:
+                self.stream.writeln(" in %.3f" % elapsed_time)
+            if self.early_details:
+                if self._detail:
+                    self.stream.writeln(self.separator1)
+                    self.stream.writeln(self._detail)
+                    self.stream.writeln(self.separator2)
+                    self._detail = ""
+            unittest2.TestResult.stopTest(self, test)
+            if self.stream_fd is not None:
+                self.streamResults(stopped=test.id())
 
     def addExpectedFailure(self, test, err=None, details=None):
         details = self._err_to_details(test, err, details)
@@ -594,13 +838,14 @@ class WellRestedTestResult(
         if self.wrt_client:
             details = self.wrt_client.markTestStatus(
                 test, 'xfail', details=details, reason=reason)
-        if self.showAll:
-            self.stream.write("expected failure")
-        elif self.dots:
-            self.stream.write("x")
-            self.stream.flush()
-        details = self._details_to_str(details)
-        self.expectedFailures.append((self.getDescription(test), details))
+        with self.reportLock:
+            if self.showAll:
+                self.stream.write("expected failure")
+            elif self.dots:
+                self.stream.write("x")
+                self.stream.flush()
+            details = self._details_to_str(details)
+            self.expectedFailures.append((self.getDescription(test), details))
 
     def addError(self, test, err=None, details=None):
         details = self._err_to_details(test, err, details)
@@ -609,24 +854,39 @@ class WellRestedTestResult(
         if self.wrt_client:
             details = self.wrt_client.markTestStatus(
                 test, 'fail', details=details, reason=reason)
-        if self.showAll:
-            self.stream.write("ERROR")
-            if reason:
-                self.stream.write(' %s ' % reason)
-        elif self.dots:
-            self.stream.write('E')
-            self.stream.flush()
-        self.print_or_append(test, details, reason, self.errors)
-        if self.failfast:
-            self.stop()
-        # this isn't my favorite place to put this, but i can't override
-        # self.shouldStop with @property shouldStop.
-        elif self.fail_percent and self._expected_tests and \
-                'Error handling fixtures' in self.reasons:
-            if self.reasons['Error handling fixtures'] > (
-                    self._expected_tests * (self.fail_percent / 100)):
+        with self.reportLock:
+            if self.showAll:
+                self.stream.write("ERROR")
+                if reason:
+                    self.stream.write(' %s ' % reason)
+            elif self.dots:
+                self.stream.write('E')
+                self.stream.flush()
+            self.print_or_append(test, details, reason, self.errors)
+            if self.failfast:
+                self.stop()
+            # this isn't my favorite place to put this, but i can't override
+            # self.shouldStop with @property shouldStop.
+            elif self._tooManyFixtureFailures():
                 self.stop()
 
+    def addAborted(self, test_id, why):
+        """Report a test a parallel worker started, but never finished."""
+        details = {
+            'traceback': content.text_content(why),
+            'reason': content.text_content('Worker aborted'),
+        }
+        # not under absorbLock, addError waits on the server
+        self.addError(_Aborted(test_id), details=details)
+        if self.showAll:
+            self.stream.writeln()
+
+    def _tooManyFixtureFailures(self):
+        return bool(self.fail_percent and self._expected_tests and
+                    'Error handling fixtures' in self.reasons and
+                    self.reasons['Error handling fixtures'] > (
+                        self._expected_tests * (self.fail_percent / 100.0)))
+
     def addFailure(self, test, err=None, details=None):
         details = self._err_to_details(test, err, details)
         reason = self._process_reason(details)
@@ -634,86 +894,101 @@ class WellRestedTestResult(
         if self.wrt_client:
             details = self.wrt_client.markTestStatus(
                 test, 'fail', details=details, reason=reason)
-        if self.showAll:
-            self.stream.write("FAIL")
-            if reason:
-                self.stream.write(' %s ' % reason)
-        elif self.dots:
-            self.stream.write('F')
-            self.stream.flush()
-        self.print_or_append(test, details, reason, self.failures)
-        if self.failfast:
-            self.stop()
+        with self.reportLock:
+            if self.showAll:
+                self.stream.write("FAIL")
+                if reason:
+                    self.stream.write(' %s ' % reason)
+            elif self.dots:
+                self.stream.write('F')
+                self.stream.flush()
+            self.print_or_append(test, details, reason, self.failures)
+            if self.failfast:
+                self.stop()
 
     def addSkip(self, test, reason=None, details=None):
         if reason is None:
             reason = self._process_reason(details)
         if self.wrt_client:
             self.wrt_client.markTestStatus(test, 'skip', reason=reason)
-        if self.showAll:
-            self.stream.write("skipped %s" % reason)
-        elif self.dots:
-            self.stream.write("s")
-            self.stream.flush()
-        # testtools does it strangely. do it less strangely
-        self.skipped.append((self.getDescription(test), reason))
+        with self.reportLock:
+            if self.showAll:
+                self.stream.write("skipped %s" % reason)
+            elif self.dots:
+                self.stream.write("s")
+                self.stream.flush()
+            # testtools does it strangely. do it less strangely
+            self.skipped.append((self.getDescription(test), reason))
 
     def addSuccess(self, test, details=None):
         details = self._details_to_storage(test, 'pass', details)
         if self.wrt_client:
             self.wrt_client.markTestStatus(
                 test, 'pass', details=details if self.store_pass else None)
-        if self.showAll:
-            self.stream.write("ok")
-        elif self.dots:
-            self.stream.write('.')
-            self.stream.flush()
-        if self.store_pass:
-            self.print_or_append(test, details, "Pass", None)
+        with self.reportLock:
+            if self.showAll:
+                self.stream.write("ok")
+            elif self.dots:
+                self.stream.write('.')
+                self.stream.flush()
+            if self.store_pass:
+                self.print_or_append(test, details, "Pass", None)
 
     def addUnexpectedSuccess(self, test, details=None):
         details = self._details_to_storage(test, 'xpass', details)
         if self.wrt_client:
             self.wrt_client.markTestStatus(
                 test, 'xpass', details=details if self.store_pass else None)
-        if self.showAll:
-            self.stream.write("unexpected success")
-        elif self.dots:
-            self.stream.write("u")
-            self.stream.flush()
-        if self.store_pass:
-            self.print_or_append(test, details, "Pass", None)
-        else:
-            self.unexpectedSuccesses.append(self.getDescription(test))
+        with self.reportLock:
+            if self.showAll:
+                self.stream.write("unexpected success")
+            elif self.dots:
+                self.stream.write("u")
+                self.stream.flush()
+            if self.store_pass:
+                self.print_or_append(test, details, "Pass", None)
+            else:
+                self.unexpectedSuccesses.append(self.getDescription(test))
 
     # fixture related methods
     def startFixture(self, fixture):
-        self.fixtures += 1
-        fix_id = fixture.id()
-        self.test_start_time[fix_id] = time.time()
+        # --threaded workers may be setting up the same fixture at once
+        use_id = wrtclient.use_id(fixture)
+        start_time = time.time()
         if self.wrt_conf:
-            self.wrt_client.startFixture(
-                fixture, self.format_time(self.test_start_time[fix_id]))
-        if self.showAll:
-            if self.timestamp:
-                self.stream.write(self.format_time(self.test_start_time[fix_id]) + ' ')
-            self.stream.write("%s ... " % self.getDescription(fixture))
+            self.wrt_client.startFixture(fixture, self.format_time(start_time))
+        with self.reportLock:
+            self.fixtures += 1
+            self.test_start_time[use_id] = start_time
+            if self.showAll:
+                if self.timestamp:
+                    self.stream.write(self.format_time(start_time) + ' ')
+                self.stream.write("%s ... " % self.getDescription(fixture))
+            if self.stream_fd is not None:
+                self.streamResults()
 
     def stopFixture(self, fixture):
-        fix_id = fixture.id()
-        self.test_end_time[fix_id] = time.time()
-        elapsed_time = self.test_end_time[fix_id] - self.test_start_time[fix_id]
+        use_id = wrtclient.use_id(fixture)
+        end_time = time.time()
+        elapsed_time = end_time - self.test_start_time[use_id]
         if self.wrt_conf:
             self.wrt_client.stopFixture(
-                fixture, self.format_time(self.test_end_time[fixture.id()]), elapsed_time)
-        if self.showAll:
-            self.stream.writeln(" in %.3f" % elapsed_time)
-        if self.early_details:
-            if self._detail:
-                self.stream.writeln(self.separator1)
-                self.stream.writeln(self._detail)
-                self.stream.writeln(self.separator2)
-                self._detail = ""
+                fixture, self.format_time(end_time), elapsed_time)
+        with self.reportLock:
+            self.test_end_time[use_id] = end_time
+            # the collector times just the work, if it can
+            duration = getattr(fixture, 'duration', None)
+            self.durations[fixture.id()] = elapsed_time if duration is None else duration
+            if self.showAll:
+                self.stream.writeln(" in %.3f" % elapsed_time)
+            if self.early_details:
+                if self._detail:
+                    self.stream.writeln(self.separator1)
+                    self.stream.writeln(self._detail)
+                    self.stream.writeln(self.separator2)
+                    self._detail = ""
+            if self.stream_fd is not None:
+                self.streamResults()
 
     def addWarning(self, fixture, err=None, details=None):
         """
@@ -725,15 +1000,16 @@ class WellRestedTestResult(
         details = self._details_to_storage(fixture, 'fail', details)
         if self.wrt_conf:
             details = self.wrt_client.markFixtureStatus(
-                fixture, 'fail', details, reason)
-        if self.showAll:
-            self.stream.write("warning")
-            if reason:
-                self.stream.write(' %s ' % reason)
-        elif self.dots:
-            self.stream.write('w')
-            self.stream.flush()
-        self.print_or_append(fixture, details, reason, self.warnings)
+                fixture, 'fail', details=details, reason=reason)
+        with self.reportLock:
+            if self.showAll:
+                self.stream.write("warning")
+                if reason:
+                    self.stream.write(' %s ' % reason)
+            elif self.dots:
+                self.stream.write('w')
+                self.stream.flush()
+            self.print_or_append(fixture, details, reason, self.warnings)
 
     def addInfo(self, fixture, details=None):
         """
@@ -743,15 +1019,16 @@ class WellRestedTestResult(
         if self.wrt_conf:
             self.wrt_client.markFixtureStatus(
                 fixture, 'pass', details=details if self.store_pass else None)
-        if self.showAll:
-            self.stream.write("ok")
-        elif self.dots:
-            self.stream.write(',')
-            self.stream.flush()
-        if self.store_pass:
-            self.print_or_append(fixture, details, "Pass", self.infos)
-        else:
-            self.infos.append(self.getDescription(fixture))
+        with self.reportLock:
+            if self.showAll:
+                self.stream.write("ok")
+            elif self.dots:
+                self.stream.write(',')
+                self.stream.flush()
+            if self.store_pass:
+                self.print_or_append(fixture, details, "Pass", self.infos)
+            else:
+                self.infos.append(self.getDescription(fixture))
 
     # summarizing methods
     def wasSuccessful(self):
@@ -771,6 +1048,8 @@ class WellRestedTestResult(
         # only put failing / errored *tests* in failing file, not fixtures
         if self.failing_file and lst is not None and lst in [self.errors, self.failures]:
             self.failing_fh.writeln(test.id())
+            if self.stream_fd is not None:
+                self._failing.append(test.id())
         description = self.getDescription(test)
         # don't try to print anything if we don't have a list to print to
         if self.early_details:
@@ -839,12 +1118,12 @@ class WellRestedTestResult(
             summary.append(" (%s)" % (", ".join(reasons)))
         if infos:
             summary.append(" (%s)\n" % (", ".join(infos),))
-        if self.wrt_conf:
+        if self.run_url:
             summary.append(self.run_url)
         return "\n".join(summary)
 
     @property
     def run_url(self):
-        if not self.wrt_conf:
+        if not self.wrt_conf or not self.wrt_client._run_url:
             return None
         return self.wrt_client._run_url.replace('api/', '').replace('s/', '/')
@@ -4,13 +4,19 @@ import testtools
 import fixtures
 import unittest2
 import itertools
+import collections
+import heapq
 import traceback
 import os
 import sys
-from threading import Thread
+import time
+from threading import Thread, Lock, RLock, Condition, local, current_thread
 import subprocess
+import fcntl
 import content
-import inspect
+from pool import WorkerPool
+from cache import Timings
+from records import WorkerProgress, heartbeat_interval
 
 
 __all__ = [
@@ -24,16 +30,21 @@ __unittest = True
 testresources.__unittest = True
 
 
+_UPSTACK_FUNCTIONS = frozenset([
+    'run', '__call__',  # for test cases
+    '_make_all', '_clean_all', 'reset', 'isDirty',  # for resources
+])
+
+
 def addDetail_upStack(name, content):
-    stack = inspect.stack()
-    for frame in stack:
-        if frame[3] in [
-            'run', '__call__', # for test cases
-            '_make_all', '_clean_all', 'reset', 'isDirty', # for resources
-        ]:
-            self = frame[0].f_locals.get('self')
+    # walk the frames themselves, inspect.stack() reads the source of each
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_name in _UPSTACK_FUNCTIONS:
+            self = frame.f_locals.get('self')
             if hasattr(self, 'addDetail'):
                 self.addDetail(name, content)
+        frame = frame.f_back
 
 
 class RoundRobinList(list):
@@ -51,8 +62,144 @@ class RoundRobinList(list):
             self._iter.next().append(item)
 
 
+class WorkStealingQueues(object):
+    """
+    A deque of batches of tests for each worker. A worker takes batches
+    from the front of its own deque, and once that's empty, from the back
+    of whichever deque has the most tests left.
+    """
+
+    def __init__(self, num):
+        self.deques = [collections.deque() for i in range(num)]
+        self.lock = Lock()
+
+    @staticmethod
+    def _size(batches):
+        return sum(len(batch) for batch in batches)
+
+    def add(self, batches):
+        """Give batches which share resources to the least loaded worker."""
+        min(self.deques, key=self._size).extend(batches)
+
+    def next(self, worker):
+        """The next batch for `worker` (from 1), or None when all is done."""
+        with self.lock:
+            own = self.deques[worker - 1]
+            if own:
+                return own.popleft()
+            busiest = max(self.deques, key=self._size)
+            if busiest:
+                return busiest.pop()
+        return None
+
+
+class Slots(object):
+    """
+    The slots the concurrency groups of `--concurrency auto` share, one
+    for each worker of the most concurrent group. A worker for tests with
+    concurrency c takes total / c of them (rounded up), so a test with
+    concurrency 1 still runs alone, while groups that fit run at once.
+
+    Each worker is lent a number (from 1) no other worker has meanwhile.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.free = total
+        self.numbers = range(1, total + 1)
+        self.condition = Condition()
+
+    def need(self, concurrency):
+        return -(-self.total // concurrency)
+
+    def acquire(self, count):
+        """Wait for count slots, and return the worker number to use."""
+        with self.condition:
+            while self.free < count:
+                self.condition.wait()
+            self.free -= count
+            return self.numbers.pop(0)
+
+    def release(self, count, number):
+        with self.condition:
+            self.free += count
+            self.numbers.append(number)
+            self.numbers.sort()
+            self.condition.notify_all()
+
+
+class ThreadStream(object):
+    """
+    Stands in for sys.stdout or sys.stderr while resources are set up in
+    several threads, so that each thread's output can be redirected on
+    its own.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = local()
+
+    def __getattr__(self, attr):
+        return getattr(getattr(self.local, 'stream', self.stream), attr)
+
+    def redirect(self, stream):
+        """A fixture redirecting the current thread's output to stream."""
+        def redirect():
+            previous = getattr(self.local, 'stream', self.stream)
+            self.local.stream = stream
+            return previous
+        return fixtures.FunctionFixture(
+            redirect, lambda previous: setattr(self.local, 'stream', previous))
+
+
+class ThreadOutput(fixtures.Fixture):
+    """
+    Lets each thread's output and logging be captured on its own while
+    threads run at once. Output that isn't captured goes where it would
+    have, logging that isn't is thrown away.
+    """
+
+    def _setUp(self):
+        if isinstance(sys.stderr, ThreadStream):  # already
+            return
+        self.useFixture(fixtures.MonkeyPatch('sys.stdout', ThreadStream(sys.stdout)))
+        self.useFixture(fixtures.MonkeyPatch('sys.stderr', ThreadStream(sys.stderr)))
+        self.useFixture(fixtures.FakeLogger())
+
+
+class _CurrentThreadFilter(logging.Filter):
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.thread = current_thread().ident
+
+    def filter(self, record):
+        return record.thread == self.thread
+
+
+class ThreadLogger(fixtures.Fixture):
+    """
+    Like fixtures.FakeLogger, but captures the current thread's logging
+    only, and leaves the other handlers alone.
+    """
+
+    def __init__(self, format):
+        super(ThreadLogger, self).__init__()
+        self.format = format
+
+    def _setUp(self):
+        output = self.useFixture(fixtures.StringStream(u"pythonlogging:''")).stream
+        handler = logging.StreamHandler(output)
+        handler.setFormatter(logging.Formatter(self.format))
+        handler.addFilter(_CurrentThreadFilter())
+        self.useFixture(fixtures.LogHandler(handler, nuke_handlers=False))
+
+
 class DetailCollector(object):
 
+    # results aren't expecting to be called from several threads
+    report_lock = Lock()
+
     def __init__(self, TRM, result, appendix):
         self.TRM = TRM
         self.appendix = appendix
@@ -61,29 +208,43 @@ class DetailCollector(object):
                 "%s is not a testtools.TestResult" % result.__class__)
         self.result = result
 
+    @staticmethod
+    def redirect(name, stream):
+        current = getattr(sys, name)
+        if isinstance(current, ThreadStream):
+            return current.redirect(stream)
+        return fixtures.MonkeyPatch('sys.%s' % name, stream)
+
     def __enter__(self):
         # capture logging
         FORMAT = '%(asctime)s [%(levelname)s] %(name)s %(lineno)d: %(message)s'  # noqa
-        self.log_fixture = fixtures.FakeLogger(format=FORMAT)
+        if isinstance(sys.stderr, ThreadStream):  # set up in several threads
+            self.log_fixture = ThreadLogger(FORMAT)
+        else:
+            self.log_fixture = fixtures.FakeLogger(format=FORMAT)
         self.log_fixture.setUp()
         # capture stderr
         if self.TRM._capture_error:
             self.stderr_stream_fixture = fixtures.StringStream('stderr')
             self.stderr_stream_fixture.setUp()
-            self.stderr_fixture = fixtures.MonkeyPatch(
-                'sys.stderr', self.stderr_stream_fixture.stream)
+            self.stderr_fixture = self.redirect(
+                'stderr', self.stderr_stream_fixture.stream)
             self.stderr_fixture.setUp()
         # capture stdout
         if self.TRM._capture_output:
             self.stdout_stream_fixture = fixtures.StringStream('stdout')
             self.stdout_stream_fixture.setUp()
-            self.stdout_fixture = fixtures.MonkeyPatch(
-                'sys.stdout', self.stdout_stream_fixture.stream)
+            self.stdout_fixture = self.redirect(
+                'stdout', self.stdout_stream_fixture.stream)
             self.stdout_fixture.setUp()
         self.TRM.appendix = self.appendix
-        self.result.startFixture(self.TRM)
+        with self.report_lock:
+            self.result.startFixture(self.TRM)
+        self.start_time = time.time()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        # how long the work took, without the capturing and reporting
+        self.TRM.duration = time.time() - self.start_time
         # add current exception as detail
         if exc_val and exc_type != KeyboardInterrupt:
             # if i use straight-up content.traceback_content, no traceback will
@@ -109,13 +270,46 @@ class DetailCollector(object):
             self.stderr_fixture.cleanUp()
 
         # update the result
-        if exc_val and exc_type != KeyboardInterrupt:
-            self.result.addWarning(self.TRM, details=details)
-        else:
-            self.result.addInfo(self.TRM, details=details)
-        self.TRM.resetDetails()
-        self.result.stopFixture(self.TRM)
+        with self.report_lock:
+            if exc_val and exc_type != KeyboardInterrupt:
+                self.result.addWarning(self.TRM, details=details)
+            else:
+                self.result.addInfo(self.TRM, details=details)
+            self.TRM.resetDetails()
+            self.result.stopFixture(self.TRM)
         self.TRM.appendix = ''
+        self.TRM.duration = None
+
+
+# the --threaded worker each thread works for, see ThreadedSuite
+_threaded_worker = local()
+
+
+def threaded_worker():
+    """The --threaded worker the current thread works for, if any."""
+    return getattr(_threaded_worker, 'number', None)
+
+
+class _ResourceState(object):
+    """What a resource manager keeps for each --threaded worker."""
+
+    def __init__(self):
+        self.uses = 0
+        self.currentResource = None
+        self.dirty = False
+        # (generation, whether a dependency was dirty) from isDirty
+        self.dirty_checked = (None, None)
+        self.appendix = ''
+        # of the current make, clean or reset, set by the collector
+        self.duration = None
+        self.details = {}
+        # threads setting up resources at once may share this one
+        self.lock = RLock()
+
+
+def _per_worker(name):
+    return property(lambda self: getattr(self._state, name),
+                    lambda self, value: setattr(self._state, name, value))
 
 
 class ReportingTestResourceManager(testresources.TestResourceManager):
@@ -127,14 +321,34 @@ class ReportingTestResourceManager(testresources.TestResourceManager):
     collector_class = DetailCollector
     _capture_error = True
     _capture_output = True
+    # with --threaded, each worker thread makes its own resource ('local'),
+    # or they all use the one ('shared'), which must be safe to use at once
+    thread_policy = 'local'
+    # moves on whenever any resource is made, reset, cleaned or dirtied
+    _generations = itertools.count(1)
+    _generation = 0
+
+    _uses = _per_worker('uses')
+    _currentResource = _per_worker('currentResource')
+    _dirty_checked = _per_worker('dirty_checked')
+    appendix = _per_worker('appendix')
+    duration = _per_worker('duration')
 
     def __init__(self, level=logging.INFO):
         super(ReportingTestResourceManager, self).__init__()
         self.log_level = level
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.appendix = ''
         self.worker = os.getenv('WRT_WORKER_ID', None)
-        self.__details = {}
+
+    @property
+    def _state(self):
+        # worker -> _ResourceState
+        states = self.__dict__.setdefault('_states', {})
+        worker = threaded_worker() if self.thread_policy == 'local' else None
+        try:
+            return states[worker]
+        except KeyError:
+            return states.setdefault(worker, _ResourceState())
 
     def __str__(self):
         return self.appendix + '_' + self.__class__.__name__
@@ -142,6 +356,16 @@ class ReportingTestResourceManager(testresources.TestResourceManager):
     def id(self):
         return self.__str__()
 
+    def use_id(self):
+        """
+        id(), and for a 'local' resource the --threaded worker using it, as
+        each worker thread makes and reports its own under the same id().
+        """
+        worker = threaded_worker() if self.thread_policy == 'local' else None
+        if worker is None:
+            return self.id()
+        return '%s (%s)' % (self.id(), worker)
+
     def addDetail(self, name, content_object, override=False):
         """Add a detail to be reported with this test's outcome.
 
@@ -156,20 +380,29 @@ class ReportingTestResourceManager(testresources.TestResourceManager):
         # ensure the name is unique
         index = 0
         try_name = name
-        while try_name in self.__details and not override:
+        details = self.getDetails()
+        while try_name in details and not override:
             index += 1
             try_name = '%s-%s' % (name, index)
-        self.__details[try_name] = content_object
+        details[try_name] = content_object
 
     def getDetails(self):
         """Get the details dict that will be reported with this test's outcome.
 
         For more details see pydoc testtools.TestResult.
         """
-        return self.__details
+        return self._state.details
 
     def resetDetails(self):
-        self.__details = {}
+        self._state.details = {}
+
+    def getResource(self, result=None):
+        with self._state.lock:
+            return super(ReportingTestResourceManager, self).getResource(result)
+
+    def finishedWith(self, resource, result=None):
+        with self._state.lock:
+            super(ReportingTestResourceManager, self).finishedWith(resource, result)
 
     # fix _make_all, _clean_all, and isDirty to use result and
     # inject the context manager to manage results
@@ -204,26 +437,51 @@ class ReportingTestResourceManager(testresources.TestResourceManager):
         #  - reset all dependencies all, getting new attributes.
         #  - call self._reset(old_resource, dependency_attributes)
         #    [the default implementation does a clean + make]
-        if not self.isDirty():
-            return old_resource
-        dependency_resources = {}
-        for name, mgr in self.resources:
-            dependency_resources[name] = mgr.reset(
-                getattr(old_resource, name), result)
-        with self.collector_class(self, result, 'Resetting'):
-            resource = self._reset(old_resource, dependency_resources)
-        for name, value in dependency_resources.items():
-            setattr(resource, name, value)
-        return resource
+        with self._state.lock:
+            if not self.isDirty():
+                return old_resource
+            dependency_resources = {}
+            for name, mgr in self.resources:
+                dependency_resources[name] = mgr.reset(
+                    getattr(old_resource, name), result)
+            with self.collector_class(self, result, 'Resetting'):
+                resource = self._reset(old_resource, dependency_resources)
+            for name, value in dependency_resources.items():
+                setattr(resource, name, value)
+            return resource
+
+    @property
+    def _dirty(self):
+        return self._state.dirty
+
+    @_dirty.setter
+    def _dirty(self, dirty):
+        self._state.dirty = dirty
+        ReportingTestResourceManager._generation = next(self._generations)
 
     def isDirty(self, result=None):
         """Return True if this managers cached resource is dirty.
 
         Calling when the resource is not currently held has undefined
         behaviour.
+
+        The dependencies are only checked again once something has changed
+        since they last were, so that getResource, then reset, then the
+        resources depending on this one don't each walk the tree again.
         """
         if self._dirty:
             return True
+        generation, dirty = self._dirty_checked
+        if generation == self._generation:
+            return dirty
+        generation = self._generation
+        dirty = self._dependencyDirty(result)
+        # unless checking changed something
+        if generation == self._generation:
+            self._dirty_checked = (generation, dirty)
+        return dirty
+
+    def _dependencyDirty(self, result):
         for name, mgr in self.resources:
             if mgr.isDirty(result):
                 return True
@@ -233,46 +491,164 @@ class ReportingTestResourceManager(testresources.TestResourceManager):
                     return True
             finally:
                 mgr.finishedWith(res, result)
+        return False
 
 
 class ParallelSuite(unittest2.TestSuite):
 
-    def __init__(self, tests, worker, testNames, debug=False):
+    # so no worker inherits the end of another worker's pipes
+    spawn_lock = Lock()
+
+    def __init__(self, tests, worker, testNames, debug=False, setup_threads=1,
+                 timeout=0):
         self._tests = tests
         from loader import AutoDiscoveringTestLoader
         self.worker = worker
         self.testNames = testNames
         self.debug = debug
+        self.setup_threads = setup_threads
+        self.timeout = timeout
 
     def run(self, result):
-        if not self._tests:
-            return result
+        tests = self._tests
+        # if the worker dies, start another with the tests it didn't start
+        while tests:
+            progress = WorkerProgress()
+            if self._spawn(tests, result, progress) or result.shouldStop:
+                break
+            tests = progress.unfinished(result, self.worker, tests)
+        return result
 
+    def _spawn(self, tests, result, progress):
         # write the tests out to a file so the command line won't be too long
         with open('.worker%s' % self.worker, 'wb') as f:
-            f.write('\n'.join(self._tests))
+            f.write('\n'.join(tests))
 
         # build command -
         # don't pipe stderr to stdout, or the dots won't be visible in real-time
         command = [
             'WRT_WORKER_ID=%s' % self.worker,
-            'wrtest',
         ]
+        handoff = result.handoff()
+        if handoff:
+            command.append('WRT_HANDOFF=%s' % handoff)
+        # so the process is wrtest, not a shell, if it has to be killed
+        command.append('exec wrtest')
         if self.debug:
             command.append('--debug')
             if self.debug > 1:
                 command.append('--debug')
+        if self.setup_threads > 1:
+            command.append('--setup-threads %s' % self.setup_threads)
         command.extend(result.worker_flags())
         command.append('--from-file .worker%s' % self.worker)
         command.append(' '.join(self.testNames))
         command = ' '.join(command)
-        if self.debug:
-            result.stream.writeln(command)
 
-        # output will contain dumped json of the worker's results
-        subprocess.call(command, shell=True)
-        with open('.worker%s' % self.worker, 'rb') as f:
-            result.absorbResult(f.read())
+        # the worker sends its results down a pipe as it goes,
+        # and is told to stop early down another
+        with self.spawn_lock:
+            records, send = os.pipe()
+            listen, stop = os.pipe()
+            for fd in (records, send, listen, stop):
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            command = 'WRT_STREAM_FD=%s WRT_CONTROL_FD=%s %s' % (send, listen, command)
+            if self.timeout:
+                command = 'WRT_HEARTBEAT=%s %s' % (heartbeat_interval(self.timeout), command)
+            if self.debug:
+                result.stream.writeln(command)
+
+            def inherit():
+                for fd in (send, listen):
+                    fcntl.fcntl(fd, fcntl.F_SETFD, 0)
+
+            process = subprocess.Popen(command, shell=True, preexec_fn=inherit)
+            os.close(send)
+            os.close(listen)
+        result.addControl(stop)
+        try:
+            finished = progress.absorb(result, records, self.timeout)
+            if progress.timed_out:
+                process.kill()
+            return finished
+        finally:
+            result.removeControl(stop)
+            os.close(stop)
+            os.close(records)
+            process.wait()
+
+
+class ForkedSuite(unittest2.TestSuite):
+    """
+    Runs its tests in a worker from a WorkerPool, rather than a new wrtest.
+    Given queues, runs batches from them until there are none left instead.
+    """
+
+    def __init__(self, tests, worker, pool, queues=None):
+        self._tests = tests
+        self.worker = worker
+        self.pool = pool
+        self.queues = queues
+        # which of the queues is this worker's own
+        self.queue = worker
+
+    def run(self, result):
+        if self.queues is None:
+            if self._tests:
+                self.pool.run(self.worker, self._tests, result)
+            return result
+        while not result.shouldStop:
+            batch = self.queues.next(self.queue)
+            if batch is None:
+                break
+            self.pool.run(self.worker, [test.id() for test in batch], result,
+                          keep=True)
+        # nothing left, tear down
+        self.pool.run(self.worker, [], result)
+        return result
+
+
+class ThreadedSuite(unittest2.TestSuite):
+    """
+    Runs its tests in a thread of this process, with a suite of its own,
+    rather than in a new wrtest (--threaded). Given queues, runs batches
+    from them until there are none left instead.
+    """
+
+    def __init__(self, tests, worker, suite, queues=None):
+        self._tests = tests
+        self.worker = worker
+        self.suite = suite
+        self.queues = queues
+        # which of the queues is this worker's own
+        self.queue = worker
+
+    def run(self, result):
+        _threaded_worker.number = self.worker
+        try:
+            if self.queues is None:
+                if self._tests:
+                    self.runBatch(self._tests, result)
+                return result
+            while not result.shouldStop:
+                batch = self.queues.next(self.queue)
+                if batch is None:
+                    break
+                self.runBatch(batch, result, keep=True)
+            # nothing left, tear down
+            self.runBatch([], result)
+            return result
+        finally:
+            del _threaded_worker.number
+
+    def runBatch(self, tests, result, keep=False):
+        """:param keep: leave the resources set up for the next batch"""
+        self.suite._tests = tests
+        self.suite.keep_resources = keep
+        try:
+            self.suite.run(result)
+        except KeyboardInterrupt:  # how the suite says it was told to stop
+            pass
 
 
 class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittest2.TestSuite):
@@ -283,7 +659,11 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
     This requires dynamic tracking of the current resources
     """
 
-    current_resources = set()
+    # partitions with more resource sets than this are ordered by
+    # _greedyOrder, which is quicker than testresources' for large ones
+    large_partition = 50
+    # how long _greedyOrder may spend improving an order
+    order_seconds = 1.0
 
     @staticmethod
     def parserOptions(parser):
@@ -302,6 +682,29 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
                            help='Run tests in parallel (up to --concurrency threads).')
         group.add_argument('--concurrency', dest='concurrency', default=2,
                            help='Number of parallel threads (default 2), or `auto`.')
+        group.add_argument('--fork', dest='fork', action='store_true',
+                           help='Fork parallel workers from this process, rather '
+                                'than starting a new wrtest for each (default False).')
+        group.add_argument('--threaded', dest='threaded', action='store_true',
+                           help='Run parallel workers as threads of this process, '
+                                'for tests which mostly wait, rather than starting '
+                                'a new wrtest for each (default False).')
+        group.add_argument('--schedule', dest='schedule', default='static',
+                           choices=['static', 'duration', 'dynamic'],
+                           help='Divide tests between parallel workers before they '
+                                'start, in turn (static, default) or by how long '
+                                'they took last time (duration), or hand them out '
+                                'as workers become free (dynamic, implies --fork '
+                                'unless --threaded).')
+        group.add_argument('--setup-threads', dest='setup_threads', type=int, default=1,
+                           help='Set up to this many resources at the same time, '
+                                'where they don\'t depend on each other (default 1).')
+        group.add_argument('--worker-timeout', dest='worker_timeout', type=float,
+                           default=0,
+                           help='Replace a parallel worker that goes this many '
+                                'seconds without starting or finishing a test or '
+                                'fixture, and report the test it was running as '
+                                'aborted (default 0, never).')
         return parser
 
     def set_flags(self, object):
@@ -312,6 +715,17 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
         self.list_tests = object.list_tests if hasattr(object, 'list_tests') else False
         self.debug = object.debug if hasattr(object, 'debug') else 0
         self.reverse = object.reverse if hasattr(object, 'reverse') else False
+        self.schedule = object.schedule if hasattr(object, 'schedule') else 'static'
+        self.threaded = object.threaded if hasattr(object, 'threaded') else False
+        self.fork = ((object.fork if hasattr(object, 'fork') else False) or
+                     self.schedule == 'dynamic') and not self.threaded
+        # timings are read from the default file even when they aren't kept
+        self.timings_file = (object.timings_file if
+            hasattr(object, 'timings_file') else None) or '.wrt-timings'
+        self.setup_threads = object.setup_threads if \
+            hasattr(object, 'setup_threads') else 1
+        self.worker_timeout = object.worker_timeout if \
+            hasattr(object, 'worker_timeout') else 0
         # these two are grabbed from the program object
         self.testNames = object.testNames
         self.progName = object.progName
@@ -326,10 +740,31 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
   --parallel            Run tests in parallel (up to --concurrency threads).
   --concurrency CONCURRENCY
                         Number of parallel threads (default 2), or `auto`.
+  --fork                Fork parallel workers from this process, rather than
+                        starting a new wrtest for each (default False).
+  --threaded            Run parallel workers as threads of this process, for
+                        tests which mostly wait, rather than starting a new
+                        wrtest for each (default False).
+  --schedule {static,duration,dynamic}
+                        Divide tests between parallel workers before they
+                        start, in turn (static, default) or by how long they
+                        took last time (duration), or hand them out as workers
+                        become free (dynamic, implies --fork unless
+                        --threaded).
+  --setup-threads SETUP_THREADS
+                        Set up to this many resources at the same time, where
+                        they don't depend on each other (default 1).
+  --worker-timeout WORKER_TIMEOUT
+                        Replace a parallel worker that goes this many seconds
+                        without starting or finishing a test or fixture, and
+                        report the test it was running as aborted (default 0,
+                        never).
 """ % cls.__name__
 
     def __init__(self, tests, concurrency=2, parallel=False, list_tests=False,
-                 debug=0, reverse=False, testNames=[]):
+                 debug=0, reverse=False, testNames=[], fork=False, pool=None,
+                 schedule='static', timings_file='.wrt-timings', setup_threads=1,
+                 worker_timeout=0, slots=None, threaded=False):
         super(ErrorTolerantOptimisedTestSuite, self).__init__(tests)
         self.list_tests = list_tests
         self.debug = debug
@@ -337,7 +772,27 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
         self.parallel = parallel
         self.concurrency = concurrency
         self.testNames = testNames
+        self.schedule = schedule
+        self.threaded = threaded
+        self.fork = (fork or schedule == 'dynamic') and not threaded
+        self.timings_file = timings_file
+        self.setup_threads = setup_threads
+        self.worker_timeout = worker_timeout
+        # shared by the concurrency groups of --concurrency auto
+        self.slots = slots
+        # leave resources set up at the end of the run, for the next batch
+        self.keep_resources = False
+        # the tests of a --threaded worker were registered by the suite that
+        # started it
+        self.register_tests = True
+        # workers forked by the outermost suite, shared with the suites in it
+        self.pool = pool
         self.worker = os.getenv('WRT_WORKER_ID', None)
+        # each suite tracks its own resources, a suite run from inside
+        # a test mustn't tear down the resources of the suite running it
+        self.current_resources = testresources._OrderedSet()
+        # (resource, 'Creating' or 'Destroying') -> seconds
+        self._resource_costs = None
 
     def id(self):
         if self.concurrency and self.concurrency != 'auto':
@@ -355,19 +810,123 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
 
         :param result: TestResult object to report activity on.
         """
-        new_resources = new_resource_set - self.current_resources
-        old_resources = self.current_resources - new_resource_set
+        # new_resource_set may be ordered, keep its order
+        new_resources = [resource for resource in new_resource_set
+                         if resource not in self.current_resources]
+        # tear down in the reverse of the order things were set up, and
+        # carry on past a failure so nothing else is left set up
+        old_resources = [resource for resource in reversed(self.current_resources)
+                         if resource not in new_resource_set]
+        exc_info = None
         for resource in old_resources:
-            resource.finishedWith(resource._currentResource, result)
+            try:
+                resource.finishedWith(resource._currentResource, result)
+            except Exception:
+                exc_info = exc_info or sys.exc_info()
             self.current_resources.discard(resource)
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if self.setup_threads > 1:
+            self.setUpInWaves(new_resources, result)
+            return
         for resource in new_resources:
             resource.getResource(result)
             self.current_resources.add(resource)
 
+    def setUpInWaves(self, new_resources, result):
+        """
+        Set up new_resources (dependencies first) a wave at a time, each
+        wave being those whose dependencies have all been set up, in up
+        to setup_threads threads at once.
+        """
+        waves = []
+        wave_of = {}
+        for resource in new_resources:
+            wave = 1 + max([wave_of[dependency] for name, dependency in resource.resources
+                            if dependency in wave_of] or [-1])
+            wave_of[resource] = wave
+            if wave == len(waves):
+                waves.append([])
+            waves[wave].append(resource)
+        for wave in waves:
+            if len(wave) == 1:
+                wave[0].getResource(result)
+                self.current_resources.add(wave[0])
+            else:
+                self.setUpAtOnce(wave, result)
+
+    def setUpAtOnce(self, resources, result):
+        """
+        Set up resources, which don't depend on one another, in threads.
+        Once they're all done, raise the first exception, if there was one.
+        """
+        todo = collections.deque(resources)
+        made = set()
+        errors = []
+        worker = threaded_worker()
+
+        def work():
+            # for the same --threaded worker as this thread
+            if worker is not None:
+                _threaded_worker.number = worker
+            while True:
+                try:
+                    resource = todo.popleft()
+                except IndexError:
+                    return
+                try:
+                    resource.getResource(result)
+                    made.add(resource)
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        # each thread's output and logging is captured by its DetailCollector
+        with ThreadOutput():
+            threads = [Thread(target=work)
+                       for i in range(min(self.setup_threads, len(resources)))]
+            map(lambda t: t.start(), threads)
+            map(lambda t: t.join(), threads)
+        for resource in resources:
+            if resource in made:
+                self.current_resources.add(resource)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
     def list(self):
         return [test.id() for test in self._tests]
 
     def run(self, result):
+        if (self.parallel or self.concurrency == 'auto') and not self.slots and \
+                not self.list_tests:
+            # register the tests once, here, and hand off to the workers
+            # (for --concurrency auto, before the groups start at once)
+            result.registerTests(self._tests)
+        pool = None
+        if self.fork and not self.pool and not self.list_tests and \
+                (self.parallel or self.concurrency == 'auto'):
+            # fork them all now, before there are threads about (the
+            # client's BackgroundSender waits for something to send)
+            pool = self.pool = WorkerPool(
+                self._tests, self.__class__, result.__class__,
+                result.progName, debug=self.debug, setup_threads=self.setup_threads,
+                timeout=self.worker_timeout)
+            if self.concurrency == 'auto':
+                pool.start(max(getattr(test, 'concurrency', 1) for test in self._tests))
+            else:
+                pool.start(int(self.concurrency))
+        try:
+            if self.threaded and not self.list_tests and \
+                    (self.parallel or self.concurrency == 'auto'):
+                # so the worker threads can each capture their own
+                with ThreadOutput():
+                    return self._run(result)
+            return self._run(result)
+        finally:
+            if pool:
+                pool.close()
+                self.pool = None
+
+    def _run(self, result):
         self.sortTests()  # will sub-divide for parallelization and list if parallel
         if self.reverse:
             self._tests.reverse()
@@ -375,20 +934,27 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
             for test in self.list():
                 result.stream.writeln(test)
             exit(0)
-        elif self.parallel:
+        elif self.parallel or self.slots:
+            # the concurrency groups of --concurrency auto share the slots,
+            # so they can all start at once
             threads = [Thread(
-                target=suite.run,
-                args=(result,))
+                target=self.runInSlots if self.slots else suite.run,
+                args=(suite, result) if self.slots else (result,))
                 for suite in self._tests]
             map(lambda t: t.start(), threads)
             map(lambda t: t.join(), threads)
+            # the workers were told to stop
+            if result.shouldStop:
+                raise KeyboardInterrupt('auto')
         else:
-            result.registerTests(self._tests)
+            if self.register_tests:
+                result.registerTests(self._tests)
             for test in self._tests:
                 if result.shouldStop:
                     raise KeyboardInterrupt('auto')
                 resources = getattr(test, 'resources', [])
-                new_resources = set()
+                # in the order the test lists them, dependencies first
+                new_resources = testresources._OrderedSet()
                 for name, resource in resources:
                     new_resources.update(resource.neededResources())
                 try:
@@ -422,11 +988,12 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
                     result.stopTest(test)
                     continue  # next test
                 test(result)
-            try:
-                self.switch(set(), result)
-            except Exception:
-                # this exception has already been reported, ignore it.
-                pass
+            if not self.keep_resources:
+                try:
+                    self.switch(set(), result)
+                except Exception:
+                    # this exception has already been reported, ignore it.
+                    pass
         return result
 
     def addTest(self, test_case_or_suite):
@@ -465,6 +1032,24 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
         suite._tests = filtered
         return suite
 
+    def runInSlots(self, suite, result):
+        """
+        Run a concurrency group or one of its workers, the latter once
+        there are enough slots free for it.
+        """
+        if self.concurrency == 'auto':
+            try:
+                suite.run(result)
+            except KeyboardInterrupt:  # the group was told to stop
+                pass
+            return
+        need = self.slots.need(int(self.concurrency))
+        suite.worker = self.slots.acquire(need)
+        try:
+            suite.run(result)
+        finally:
+            self.slots.release(need, suite.worker)
+
     def sortTestsByConcurrency(self):
         buckets = {}
         for test in self._tests:
@@ -476,9 +1061,14 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
         keys = buckets.keys()
         keys.sort()
         keys.reverse()
-        self._tests.extend([ErrorTolerantOptimisedTestSuite(
+        self.slots = Slots(keys[0]) if keys else None
+        self._tests.extend([self.__class__(
                 buckets[c], concurrency=c, debug=self.debug, parallel=True,
-                list_tests=self.list_tests, reverse=self.reverse, testNames=self.testNames)
+                list_tests=self.list_tests, reverse=self.reverse, testNames=self.testNames,
+                fork=self.fork, pool=self.pool, schedule=self.schedule,
+                timings_file=self.timings_file, setup_threads=self.setup_threads,
+                worker_timeout=self.worker_timeout, slots=self.slots,
+                threaded=self.threaded)
             for c in keys])
         if self.list_tests:
             for suite in self._tests:
@@ -489,6 +1079,225 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
                     pass
             exit(0)
 
+    def workerSuite(self):
+        """A suite for a --threaded worker to run its tests with."""
+        suite = self.__class__([], debug=self.debug, setup_threads=self.setup_threads,
+                               timings_file=self.timings_file)
+        suite.register_tests = False
+        return suite
+
+    def sortTestsDynamically(self, resource_set_tests, partitions):
+        """
+        Queue batches of tests for the workers to take as they become free.
+        Each batch is the tests using one set of resources, and the batches
+        of a partition start off queued for the same worker, so the
+        resources they share can be reused.
+        """
+        concurrency = int(self.concurrency)
+        queues = WorkStealingQueues(concurrency)
+        no_resources = frozenset()
+        runs = []
+        for partition in partitions:
+            if partition == [no_resources]:
+                continue
+            runs.append([list(resource_set_tests[resource_set])
+                         for resource_set in self._makeOrder(partition)])
+        # biggest first, so they end up evenly spread
+        runs.sort(key=WorkStealingQueues._size, reverse=True)
+        for batches in runs:
+            queues.add(batches)
+        # tests without resources can go anywhere, a few at a time
+        tests = resource_set_tests[no_resources]
+        size = max(1, len(tests) // (4 * concurrency))
+        for start in range(0, len(tests), size):
+            queues.add([tests[start:start + size]])
+
+        for worker, batches in enumerate(queues.deques):
+            worker += 1
+            for batch in batches:
+                if self.reverse:
+                    batch.reverse()
+            if self.list_tests:
+                sys.stderr.write('WORKER %s:\n' % worker)
+                for batch in batches:
+                    sys.stderr.write('    ')
+                    sys.stderr.write('\n    '.join(test.id() for test in batch))
+                    sys.stderr.write('\n')
+        if self.list_tests:
+            exit(0)
+        if self.threaded:
+            self._tests = [ThreadedSuite(None, worker, self.workerSuite(), queues)
+                           for worker in range(1, concurrency + 1)]
+        else:
+            self._tests = [ForkedSuite(None, worker, self.pool, queues)
+                           for worker in range(1, concurrency + 1)]
+
+    def measureResourceCosts(self):
+        """
+        How long each resource the tests use took to create and destroy
+        last time, from the --timings-file. Resources that weren't timed
+        get their setUpCost and tearDownCost instead, scaled to seconds
+        by how the timed resources compare to theirs.
+        """
+        timings = Timings(self.timings_file)
+        resources = set()
+        for test in self._tests:
+            for name, resource in getattr(test, 'resources', []):
+                resources.update(resource.neededResources())
+        costs = {}
+        untimed = []
+        measured = estimated = 0
+        for resource in resources:
+            for appendix, cost in (('Creating', resource.setUpCost),
+                                   ('Destroying', resource.tearDownCost)):
+                # as named by the DetailCollector
+                name = '%s_%s' % (appendix, resource.__class__.__name__)
+                if name in timings:
+                    costs[resource, appendix] = timings.get(name)
+                    measured += costs[resource, appendix]
+                    estimated += cost
+                else:
+                    untimed.append((resource, appendix, cost))
+        scale = float(measured) / estimated if measured and estimated else 1.0
+        for resource, appendix, cost in untimed:
+            costs[resource, appendix] = cost * scale
+        return costs
+
+    def resourceCost(self, resource, appendix):
+        if self._resource_costs is None:
+            self._resource_costs = self.measureResourceCosts()
+        return self._resource_costs[resource, appendix]
+
+    def cost_of_switching(self, old_resource_set, new_resource_set):
+        """Cost of switching from 'old_resource_set' to 'new_resource_set',
+        using measured costs where there are any."""
+        new_resources = new_resource_set - old_resource_set
+        gone_resources = old_resource_set - new_resource_set
+        return (sum(self.resourceCost(resource, 'Creating')
+                    for resource in new_resources) +
+                sum(self.resourceCost(resource, 'Destroying')
+                    for resource in gone_resources))
+
+    def _makeOrder(self, partition):
+        if len(partition) > self.large_partition:
+            return self._greedyOrder(partition)
+        return super(ErrorTolerantOptimisedTestSuite, self)._makeOrder(partition)
+
+    def _greedyOrder(self, partition):
+        """
+        Order the resource sets in partition by nearest neighbour, then
+        improve the order with 2-opt for up to order_seconds.
+
+        Counting the teardown at the end, each stretch of tests using a
+        resource costs its setUp and tearDown once, so the cost of an order
+        is the same as that of a tour starting and ending with no resources
+        where switching costs half of each resource that changes either way.
+        Being symmetric, a tour can have parts reversed without changing
+        their cost, which is what 2-opt does.
+        """
+        no_resources = frozenset()
+        deadline = time.time() + self.order_seconds
+        weight = {}
+        sharing = {}  # resource -> resource sets using it
+        resource_sets = [resource_set for resource_set in partition
+                         if resource_set != no_resources]
+        position = dict((resource_set, index)
+                        for index, resource_set in enumerate(resource_sets))
+        for resource_set in resource_sets:
+            for resource in resource_set:
+                if resource not in weight:
+                    weight[resource] = (self.resourceCost(resource, 'Creating') +
+                                        self.resourceCost(resource, 'Destroying')) / 2.0
+                sharing.setdefault(resource, []).append(resource_set)
+
+        def distance(a, b):
+            return sum(weight[resource] for resource in a ^ b)
+
+        # nearest neighbour, from no resources. Sets sharing nothing with the
+        # current one cost its weight plus theirs, so only the lightest of
+        # them need be considered, along with those sharing something.
+        lightest = [(distance(no_resources, resource_set), index, resource_set)
+                    for index, resource_set in enumerate(resource_sets)]
+        heapq.heapify(lightest)
+        remaining = set(resource_sets)
+        order = []
+        current = no_resources
+        while remaining:
+            while lightest[0][2] not in remaining:
+                heapq.heappop(lightest)
+            candidates = set([lightest[0][2]])
+            for resource in current:
+                candidates.update(resource_set for resource_set in sharing[resource]
+                                  if resource_set in remaining)
+            current = min(candidates, key=lambda candidate: (
+                distance(current, candidate), position[candidate]))
+            remaining.discard(current)
+            order.append(current)
+
+        # 2-opt: reverse tour[i:j + 1] wherever that makes it cheaper
+        tour = [no_resources] + order + [no_resources]
+        improved = True
+        while improved and time.time() < deadline:
+            improved = False
+            for i in range(1, len(tour) - 2):
+                if time.time() > deadline:
+                    break
+                before = distance(tour[i - 1], tour[i])
+                for j in range(i + 1, len(tour) - 1):
+                    change = (distance(tour[i - 1], tour[j]) +
+                              distance(tour[i], tour[j + 1]) -
+                              before - distance(tour[j], tour[j + 1]))
+                    if change < -1e-9:
+                        tour[i:j + 1] = reversed(tour[i:j + 1])
+                        before = distance(tour[i - 1], tour[i])
+                        improved = True
+        return tour[1:-1]
+
+    def packByDuration(self, resource_set_tests, partitions):
+        """
+        Divide the tests between the workers so that each takes about as long,
+        going by how long the tests and their resources took last time: the
+        longest piece of work first, each to the worker with the least to do.
+        A partition of tests sharing resources is kept together as one piece,
+        tests without resources are a piece each. Tests that haven't been
+        timed are expected to take as long as the average test that has.
+        """
+        timings = Timings(self.timings_file)
+        known = [timings.get(test.id()) for test in self._tests
+                 if test.id() in timings]
+        default = sum(known) / len(known) if known else 1.0
+
+        def duration(tests):
+            return sum(timings.get(test.id(), default) for test in tests)
+
+        def resource_duration(resource):
+            return (self.resourceCost(resource, 'Creating') +
+                    self.resourceCost(resource, 'Destroying'))
+
+        no_resources = frozenset()
+        pieces = []
+        for partition in partitions:
+            if partition == [no_resources]:
+                continue
+            resources = set().union(*partition)
+            tests = []
+            for resource_set in self._makeOrder(partition):
+                tests.extend(resource_set_tests[resource_set])
+            pieces.append((duration(tests) + sum(resource_duration(resource)
+                                                 for resource in resources), tests))
+        for test in resource_set_tests[no_resources]:
+            pieces.append((duration([test]), [test]))
+        # sort on the duration alone, keeping the order of equal pieces
+        pieces.sort(key=lambda piece: piece[0], reverse=True)
+
+        result = [[] for i in range(int(self.concurrency))]
+        loads = [(0, worker) for worker in range(len(result))]
+        for piece_duration, tests in pieces:
+            load, worker = heapq.heappop(loads)
+            result[worker].extend(tests)
+            heapq.heappush(loads, (load + piece_duration, worker))
+        return result
+
     def sortTests(self):
         """Attempt to topographically sort the contained tests.
 
@@ -501,6 +1310,8 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
         if self.concurrency == 'auto':
             self.sortTestsByConcurrency()
             return
+        # for the tests as they are now
+        self._resource_costs = None
 
         # We group the tests by the resource combinations they use,
         # since there will usually be fewer resource combinations than
@@ -522,24 +1333,32 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
         partitions = testresources._strongly_connected_components(
             resource_set_graph, no_resources)
 
-        if self.parallel:
-            result = RoundRobinList(int(self.concurrency))
-        else:
-            result = []
+        if self.parallel and self.schedule == 'dynamic' and \
+                (self.pool or self.threaded or self.list_tests):
+            self.sortTestsDynamically(resource_set_tests, partitions)
+            return
 
-        for partition in partitions:
-            # we process these at the end for no particularly good reason (it
-            # makes testing slightly easier).
-            if partition == [no_resources]:
-                continue
-            order = self._makeOrder(partition)
-            # Spit this partition out into result
-            for resource_set in order:
-                result.extend(resource_set_tests[resource_set])
-        if self.parallel:
-            result.distribute(resource_set_tests[no_resources])
+        if self.parallel and self.schedule == 'duration':
+            result = self.packByDuration(resource_set_tests, partitions)
         else:
-            result.extend(resource_set_tests[no_resources])
+            if self.parallel:
+                result = RoundRobinList(int(self.concurrency))
+            else:
+                result = []
+
+            for partition in partitions:
+                # we process these at the end for no particularly good reason (it
+                # makes testing slightly easier).
+                if partition == [no_resources]:
+                    continue
+                order = self._makeOrder(partition)
+                # Spit this partition out into result
+                for resource_set in order:
+                    result.extend(resource_set_tests[resource_set])
+            if self.parallel:
+                result.distribute(resource_set_tests[no_resources])
+            else:
+                result.extend(resource_set_tests[no_resources])
 
         if self.parallel:
             # sys.stderr.write('%s\n\n' % self._tests)
@@ -554,7 +1373,15 @@ class ErrorTolerantOptimisedTestSuite(testresources.OptimisingTestSuite, unittes
                     sys.stderr.write('    ')
                     sys.stderr.write('\n    '.join(tests))
                     sys.stderr.write('\n')
-                self._tests.append(ParallelSuite(tests, worker, self.testNames, debug=self.debug))
+                if self.pool:
+                    self._tests.append(ForkedSuite(tests, worker, self.pool))
+                elif self.threaded:
+                    self._tests.append(ThreadedSuite(batch, worker, self.workerSuite()))
+                else:
+                    self._tests.append(
+                        ParallelSuite(tests, worker, self.testNames, debug=self.debug,
+                                      setup_threads=self.setup_threads,
+                                      timeout=self.worker_timeout))
             if self.list_tests:
                 exit(0)
         else:
@@ -3,24 +3,341 @@ import os
 import json
 import subprocess
 import ConfigParser
+import Queue
+import functools
+import tempfile
+import hashlib
+import zlib
+import time
+import signal
+from threading import Thread, Lock
 import content
+from cache import MetadataCache
+from journal import Journal, encode_details
 from exceptions import *
 
 __unittest = True
 
 
+class _Identity(object):
+    """Stands in for a test or fixture whose id() may change before
+    a queued update gets sent."""
+
+    def __init__(self, test):
+        self._id = test.id()
+        self._use_id = use_id(test)
+
+    def id(self):
+        return self._id
+
+    def use_id(self):
+        return self._use_id
+
+
+def use_id(fixture):
+    """What tells a fixture's updates from those of other --threaded workers
+    setting up the same fixture, see ReportingTestResourceManager.use_id."""
+    return getattr(fixture, 'use_id', fixture.id)()
+
+
+def _freeze(details):
+    """Read the details now, they may not be readable later."""
+    if not details:
+        return details
+    frozen = {}
+    for name, value in details.items():
+        data = list(value.iter_bytes())
+        frozen[name] = content.Content(
+            value.content_type, lambda data=data: data)
+    return frozen
+
+
+def queueable(method):
+    """If the client has a BackgroundSender, queue the call to `method`
+    instead of making it. Details are returned as they were passed in."""
+    @functools.wraps(method)
+    def wrapper(self, test, *args, **kwargs):
+        if not self.sender:
+            return method(self, test, *args, **kwargs)
+        if 'details' in kwargs:
+            kwargs['details'] = _freeze(kwargs['details'])
+        self.sender.put(method, self, _Identity(test), *args, **kwargs)
+        return kwargs.get('details')
+    return wrapper
+
+
+def journaled(method):
+    """Record the call to `method` in the client's journal, if it has one,
+    and only make it if the client isn't offline."""
+    @functools.wraps(method)
+    def wrapper(self, test, *args, **kwargs):
+        if self.journal:
+            recorded = dict(kwargs)
+            # only calls that take details are recorded with them
+            if 'details' in kwargs:
+                if kwargs['details']:
+                    kwargs['details'] = _freeze(kwargs['details'])
+                recorded['details'] = encode_details(kwargs['details'])
+            fields = {}
+            if use_id(test) != test.id():
+                fields['use_id'] = use_id(test)
+            self.journal.record(method.__name__, id=test.id(),
+                                args=args, kwargs=recorded, **fields)
+        if self.offline:
+            return kwargs.get('details')
+        return method(self, test, *args, **kwargs)
+    return wrapper
+
+
+class BackgroundSender(Thread):
+    """
+    Makes the queued calls to the well-rested-tests server, in order,
+    from a background thread. Once `size` calls are waiting, queueing
+    another blocks until there is room.
+
+    The thread starts with the first call queued, so a WorkerPool can
+    fork its helper before there are any threads about.
+    """
+
+    def __init__(self, size, stream):
+        Thread.__init__(self, name='BackgroundSender')
+        self.daemon = True
+        self.stream = stream
+        self.queue = Queue.Queue(maxsize=size)
+        self.failures = 0
+        self.startLock = Lock()
+
+    def put(self, method, *args, **kwargs):
+        with self.startLock:
+            if self.ident is None:
+                self.start()
+        self.queue.put((method, args, kwargs))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            method, args, kwargs = item
+            try:
+                method(*args, **kwargs)
+            except Exception as e:
+                self.failures += 1
+                self.stream.writeln(
+                    'WARNING: %s failed for %s: %s'
+                    % (method.__name__, args[1].id(), e))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait for the queue to empty, return how many calls failed."""
+        self.queue.join()
+        failures, self.failures = self.failures, 0
+        return failures
+
+    def stop(self):
+        with self.startLock:
+            if self.ident is None:
+                return
+        self.queue.put(None)
+        self.join()
+
+
+def check_outputs(commands, timeout):
+    """
+    Run shell commands all at once, return their output in order.
+    Like subprocess.check_output, but a command still running after
+    `timeout` seconds is killed, and WRTException raised.
+    """
+    processes = [subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                                  preexec_fn=os.setsid)  # so it can be killed
+                 for command in commands]
+    outputs = [None] * len(processes)
+
+    def read(i):
+        outputs[i] = processes[i].communicate()[0]
+    threads = [Thread(target=read, args=(i,)) for i in range(len(processes))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    deadline = time.time() + timeout
+    for command, thread in zip(commands, threads):
+        thread.join(max(0, deadline - time.time()))
+        if thread.is_alive():
+            for process in processes:
+                if process.poll() is None:
+                    os.killpg(process.pid, signal.SIGKILL)
+            raise WRTException('`%s` took longer than %s seconds' % (command, timeout))
+    for command, process, output in zip(commands, processes, outputs):
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, output)
+    return outputs
+
+
+def gzipped(chunks):
+    """
+    Compress chunks with gzip. The same chunks always compress the same,
+    so compressed content can still be recognised by its digest.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def _stripped(chunks):
+    """Chunks of text without the leading and trailing whitespace of the
+    whole, as uploaded text details always have been."""
+    started = False
+    trailing = ''
+    for chunk in chunks:
+        if not started:
+            chunk = chunk.lstrip()
+            started = bool(chunk)
+        text = chunk.rstrip()
+        if text:
+            yield trailing + text
+            trailing = chunk[len(text):]
+        else:
+            trailing += chunk
+
+
+class _Spool(object):
+    """
+    A detail's content, read a chunk at a time into memory, or a file on
+    disk once it gets big, so requests can stream it with a Content-Length.
+    Its sha256 is worked out on the way, and it may be compressed on the way.
+    """
+
+    max_size = 1024 * 1024
+
+    def __init__(self, chunks, encoding=None):
+        self.file = tempfile.SpooledTemporaryFile(max_size=self.max_size)
+        self.encoding = encoding
+        self.size = 0  # before compression
+        self.len = 0
+        sha = hashlib.sha256()
+
+        def counted(chunks):
+            for chunk in chunks:
+                self.size += len(chunk)
+                yield chunk
+        chunks = counted(chunks)
+        if self.encoding:
+            chunks = gzipped(chunks)
+        for chunk in chunks:
+            self.file.write(chunk)
+            sha.update(chunk)
+            self.len += len(chunk)
+        self.digest = sha.hexdigest()
+        self.file.seek(0)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def __iter__(self):
+        self.file.seek(0)
+        return iter(lambda: self.file.read(8192), '')
+
+    def close(self):
+        self.file.close()
+
+
+class _Upload(object):
+    """A detail to upload, and its url once it has been uploaded."""
+
+    def __init__(self, spool, url=None):
+        self.spool = spool
+        self.url = url
+
+
+class UploadPool(object):
+    """
+    Uploads details to the well-rested-tests server from `size` threads,
+    each with its own session. Once twice that many uploads are waiting,
+    starting another blocks until there is room.
+    """
+
+    def __init__(self, size, stream, new_session):
+        self.stream = stream
+        self.queue = Queue.Queue(maxsize=size * 2)
+        self.failures = 0
+        self.lock = Lock()
+        self.threads = [Thread(target=self.run, args=(new_session(),),
+                               name='UploadPool-%s' % i)
+                        for i in range(size)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, upload, method, *args):
+        """
+        Call method(session, upload, *args) from one of the threads,
+        it returns the url. Use flush() to wait for it.
+        """
+        self.queue.put((upload, method, args))
+
+    def run(self, session):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            upload, method, args = item
+            try:
+                upload.url = method(session, upload, *args)
+            except Exception as e:
+                with self.lock:
+                    self.failures += 1
+                self.stream.writeln('WARNING: %s failed for %s: %s'
+                                    % (method.__name__, args, e))
+            finally:
+                if upload.spool:
+                    upload.spool.close()
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait for the uploads to finish, return how many failed."""
+        self.queue.join()
+        with self.lock:
+            failures, self.failures = self.failures, 0
+        return failures
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
 class WRTClient(object):
 
-    def __init__(self, wrt_conf, stream, debug=False, run_url=None):
+    # number of tests to register per request
+    register_chunk_size = 500
+    # number of threads uploading details, unless UPLOAD_THREADS is set
+    upload_threads = 4
+    # how text details may be compressed for upload
+    compressions = ('gzip',)
+
+    def __init__(self, wrt_conf, stream, debug=False, run_url=None,
+                 upload_queue=0, coalesce=False, journal=None, offline=False,
+                 tag_values=None):
         self.stream = stream
         self.debug = debug
+        self.coalesce = coalesce
+        # with a journal, everything sent is also recorded for `wrt replay`
+        # and offline, it is only recorded
+        self.journal = Journal(journal) if journal else None
+        self.offline = offline
+        if self.offline and not self.journal:
+            raise WRTException('offline requires a journal')
         if os.path.isfile(wrt_conf):
             self.config = ConfigParser.ConfigParser()
             self.config.read(wrt_conf)
         else:
             raise WRTConfNotFound('%s is not a file' % wrt_conf)
 
-        self.session = requests.Session()
         try:
             self.username = self.config.get('default', 'USERNAME')
             self.password = self.config.get('default', 'PASSWORD')
@@ -29,17 +346,47 @@ class WRTClient(object):
             self.protocol = self.config.get('default', 'PROTOCOL')
         except ConfigParser.Error as e:
             raise WRTConfigParamNotFound(e.message)
-        self.session.mount(
-            '%s://' % self.protocol, adapter=requests.adapters.HTTPAdapter(max_retries=3))
-        self.session.auth = (self.username, self.password)
+        self.session = self.newSession()
+        self.compression = self.option('COMPRESSION')
+        if self.compression not in (None,) + self.compressions:
+            raise WRTException('COMPRESSION must be one of %s, not %s'
+                               % (self.compressions, self.compression))
+        self.cache = MetadataCache(
+            self.option('CACHE_FILE'),
+            '%s://%s %s %s' % (self.protocol, self.server, self.project_name, self.username),
+            expire_seconds=int(self.option('CACHE_SECONDS', 86400)))
         self._project_url = None
         self._project_id = None
         self._user_url = None
         self._run_url = run_url
         self._run_id = None
         self._tags = []
+        # (name, value) pairs, as recorded in a journal
+        self._tag_values = tag_values
         self._existing_tests = {}
         self._existing_fixtures = {}
+        # whether the parent handed off what it looked up, see loadState
+        self._handed_off = False
+        # fixtures whose case url came from the cache, and may be stale,
+        # until a result has been created for it
+        self._unconfirmed_fixtures = set()
+        # fixture use_id -> url of the result of its current make or clean
+        self._fixture_results = {}
+        # with coalesce, status updates waiting for the stop update
+        self._pending = {}
+        self.sender = None
+        self._uploads = None
+        self._uploads_lock = Lock()
+        # sha256 -> url of content already on the server
+        self._attachments = {}
+        # (shown as, name, upload) of the details printed once uploaded
+        self._shown = []
+        if upload_queue:
+            self.sender = BackgroundSender(upload_queue, stream)
+        # workers pick up what the parent has already looked up
+        handoff = os.getenv('WRT_HANDOFF', None)
+        if handoff:
+            self.loadState(handoff)
         if self.debug:
             self.stream.writeln(
                 'WRTClient created for %s/%s running %s on %s' %
@@ -61,10 +408,18 @@ class WRTClient(object):
     def runs_url(self):
         return '%s://%s/api/runs/' % (self.protocol, self.server)
 
+    @property
+    def previous_run_url(self):
+        return '%s://%s/api/runs/previous/' % (self.protocol, self.server)
+
     @property
     def results_url(self):
         return '%s://%s/api/results/' % (self.protocol, self.server)
 
+    @property
+    def register_url(self):
+        return '%s://%s/api/results/register/' % (self.protocol, self.server)
+
     @property
     def tags_url(self):
         return '%s://%s/api/tags/' % (self.protocol, self.server)
@@ -77,6 +432,31 @@ class WRTClient(object):
     def details_url(self):
         return '%s://%s/api/details/' % (self.protocol, self.server)
 
+    def newSession(self):
+        session = requests.Session()
+        session.mount(
+            '%s://' % self.protocol, adapter=requests.adapters.HTTPAdapter(max_retries=3))
+        session.auth = (self.username, self.password)
+        return session
+
+    @property
+    def uploads(self):
+        # started the first time there's something to upload, which
+        # --threaded workers may have at once
+        with self._uploads_lock:
+            if not self._uploads:
+                self._uploads = UploadPool(
+                    int(self.option('UPLOAD_THREADS', self.upload_threads)),
+                    self.stream, self.newSession)
+            return self._uploads
+
+    def option(self, name, default=None):
+        """An optional setting from the [default] section of the config."""
+        try:
+            return self.config.get('default', name)
+        except ConfigParser.Error:
+            return default
+
     def raise_for_status(self, resp):
         try:
             resp.raise_for_status()
@@ -94,6 +474,8 @@ class WRTClient(object):
 
     @property
     def project_url(self):
+        if not self._project_url:
+            self._project_url = self.cache.get('project_url')
         if not self._project_url:
             if self.debug:
                 self.stream.writeln('Fetching project url')
@@ -103,6 +485,7 @@ class WRTClient(object):
             for project in projects:
                 if project['name'] == unicode(self.project_name):
                     self._project_url = project['url']
+                    self.cache.set('project_url', self._project_url)
                     return self._project_url
             raise WRTProjectNotFound('%s in %s' % (self.project_name, projects))
         return self._project_url
@@ -113,6 +496,8 @@ class WRTClient(object):
 
     @property
     def user_url(self):
+        if not self._user_url:
+            self._user_url = self.cache.get('user_url')
         if not self._user_url:
             if self.debug:
                 self.stream.writeln('Fetching user url')
@@ -122,89 +507,103 @@ class WRTClient(object):
             for user in users:
                 if user['username'] == self.username:
                     self._user_url = user['url']
+                    self.cache.set('user_url', self._user_url)
                     return self._user_url
             raise WRTUserNotFound('%s in %s' % (self.username, users))
         return self._user_url
 
+    def dumpState(self, path):
+        """Write what has been looked up or registered so far to `path`."""
+        state = {
+            'project_url': self.project_url,
+            'user_url': self.user_url,
+            'tags': self._tags,
+            'tag_values': self._tag_values,
+            'fixtures': dict((name, fixture['case_url'])
+                             for name, fixture in self._existing_fixtures.items()),
+            'tests': self._existing_tests,
+        }
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.wrt-handoff')
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(state, f)
+        # rename is atomic, so workers never see half a file
+        os.rename(temp, path)
+
+    def loadState(self, path):
+        """
+        Pick up what dumpState() wrote, instead of looking it up. It's
+        only for this run, so it's kept out of the cache.
+        """
+        with open(path, 'rb') as f:
+            state = json.load(f)
+        self._project_url = state['project_url']
+        self._user_url = state['user_url']
+        # the parent's may have come from its cache
+        self._addFixtures(state['fixtures'], cached=True)
+        self._handed_off = True
+        self._tags = state['tags']
+        self._tag_values = state['tag_values']
+        self._existing_tests.update(state['tests'])
+        if self.debug:
+            self.stream.writeln('Loaded state for %s tests from %s'
+                                % (len(self._existing_tests), path))
+
     def registerTests(self, tests):
+        if self.journal:
+            self.journal.record('registerTests',
+                                names=[test.id() for test in tests])
+        if self.offline:
+            return
         # if run_url were *always* a url and never 'previous',
         # we could have assigned _run_id during __init__,
         # but since it can be 'previous', we have to do it
         # after startTestRun()
         if not self._run_id:
             self._run_id = self.id_from_url(self._run_url)
-        for test in tests:
-            # does the test exist in the cases table?
-            params = {
-                'project': self.project_id,
-                'name': test.id(),
-                'fixture': False
-            }
-            if self.debug:
-                self.stream.writeln('Querying %s for %s' % (self.cases_url, params))
-            resp = self.session.get(self.cases_url, params=params)
-            self.raise_for_status(resp)
-            if self.debug:
-                self.stream.writeln('Found %s' % json.loads(resp.text))
-            try:
-                case = json.loads(resp.text)[0]
-            except IndexError:
-                data = {
-                    'name': test.id(),
-                    'project': self.project_url
-                }
-                if self.debug:
-                    self.stream.writeln('Adding case for test %s' % data)
-                resp = self.session.post(self.cases_url, data=data)
-                self.raise_for_status(resp)
-                case = json.loads(resp.text)
-
-            # does the test exist in the results table?
-            params = {
+        # find or create the cases and results in bulk,
+        # a chunk at a time to keep the requests a reasonable size
+        names = [test.id() for test in tests
+                 if test.id() not in self._existing_tests]
+        for start in range(0, len(names), self.register_chunk_size):
+            data = {
                 'run': self._run_id,
-                'case': case['id']
+                'names': names[start:start + self.register_chunk_size],
             }
             if self.debug:
-                self.stream.writeln('Querying %s for %s' % (self.results_url, params))
-            resp = self.session.get(self.results_url, params=params)
+                self.stream.writeln('Registering %s tests with %s'
+                                    % (len(data['names']), self.register_url))
+            resp = self.session.post(self.register_url, json=data)
             self.raise_for_status(resp)
-            if self.debug:
-                self.stream.writeln('Found %s' % json.loads(resp.text))
-            try:
-                result = json.loads(resp.text)[0]
-                if self.debug:
-                    self.stream.writeln('Updating %s' % result)
-            except IndexError:
-                # Add a result for each of the tests
-                data = {
-                    'owner': self.user_url,
-                    'case': case['url'],
-                    'run': self._run_url,
-                    'status': 'exists'
-                }
-                if self.debug:
-                    self.stream.writeln('Adding result for %s' % data)
-                resp = self.session.post(self.results_url, data=data)
-                self.raise_for_status(resp)
-                result = json.loads(resp.text)
-
-            self._existing_tests[test.id()] = {
-                'case_url': case['url'],
-                'case_id': case['id'],
-                'result_url': result['url'],
-                'result_id': result['id']
-            }
+            self._existing_tests.update(json.loads(resp.text))
         if self.debug:
             self.stream.writeln('%s' % self._existing_tests)
 
-        # create a database of existing fixtures
-        resp = self.session.get(self.cases_url, params={
-                'project': self.project_id,
-                'fixture': True
-            })
-        self.raise_for_status(resp)
-        for fixture in json.loads(resp.text):
-            self._existing_fixtures[fixture['name']] = {'case_url': fixture['url']}
+        # create a database of existing fixtures, unless the cache, or
+        # the parent, has one
+        if self._handed_off:
+            return
+        fixtures = self.cache.get('fixtures')
+        cached = fixtures is not None
+        if not cached:
+            resp = self.session.get(self.cases_url, params={
+                    'project': self.project_id,
+                    'fixture': True
+                })
+            self.raise_for_status(resp)
+            fixtures = dict((fixture['name'], fixture['url'])
+                            for fixture in json.loads(resp.text))
+            self.cache.set('fixtures', fixtures)
+        self._addFixtures(fixtures, cached)
+        self.cache.save()
+
+    def _addFixtures(self, fixtures, cached):
+        """Add {name: case url} to the fixtures known to exist."""
+        for name, case_url in fixtures.items():
+            if name not in self._existing_fixtures:
+                self._existing_fixtures[name] = {'case_url': case_url}
+                if cached:
+                    self._unconfirmed_fixtures.add(name)
 
     @property
     def tags(self):
@@ -212,7 +611,7 @@ class WRTClient(object):
             self._tags = self.buildTags()
         return self._tags
 
-    def buildTags(self):
+    def knownTags(self):
         # gather known tags for this project
         params = {
             'project': self.project_id,
@@ -227,65 +626,116 @@ class WRTClient(object):
             known_tags[pair] = tag['url']
         if self.debug:
             self.stream.writeln('KNOWN TAGS: %s' % known_tags)
+        self.cache.set('tags', known_tags)
+        return known_tags
+
+    def tagValues(self):
+        """
+        (name, value) pairs from running the commands in [tags], all at
+        once, each allowed TAG_TIMEOUT seconds. The values are cached for
+        TAG_CACHE_SECONDS (default 0, not cached).
+        """
+        if self._tag_values is None:
+            cached = self.cache.get('tag_values')
+            if cached and time.time() - cached['time'] < \
+                    int(self.option('TAG_CACHE_SECONDS', 0)):
+                self._tag_values = cached['values']
+        if self._tag_values is None:
+            try:
+                tags = self.config.items('tags')
+            except ConfigParser.Error:
+                tags = []
+                if self.debug:
+                    self.stream.writeln('WARNING: unable to parse tags from config')
+            outputs = check_outputs([command for name, command in tags],
+                                    int(self.option('TAG_TIMEOUT', 60)))
+            self._tag_values = [(name, output.strip())
+                                for (name, command), output in zip(tags, outputs)]
+            self.cache.set('tag_values', {'values': self._tag_values,
+                                          'time': time.time()})
+        return self._tag_values
+
+    def buildTags(self):
+        # the cache may know the tags already
+        known_tags = self.cache.get('tags')
+        fetched = known_tags is None
+        if fetched:
+            known_tags = self.knownTags()
         # create tag list for this run
         tag_list = []
-        try:
-            for name, command in self.config.items('tags'):
-                value = subprocess.check_output(command, shell=True).strip()
-                data = {'name': name, 'value': value, 'project': self.project_url}
-                pair = '%s %s' % (name, value)
-                if pair not in known_tags:
-                    if self.debug:
-                        self.stream.writeln('Creating tag %s' % data)
-                    resp = self.session.post(self.tags_url, data=data)
-                    self.raise_for_status(resp)
-                    known_tags[pair] = json.loads(resp.text)['url']
-                tag_list.append(known_tags[pair])
-        except ConfigParser.Error:
-            if self.debug:
-                self.stream.writeln('WARNING: unable to parse tags from config')
+        for name, value in self.tagValues():
+            data = {'name': name, 'value': value, 'project': self.project_url}
+            pair = '%s %s' % (name, value)
+            if pair not in known_tags and not fetched:
+                # someone else may have created it since we cached
+                known_tags = self.knownTags()
+                fetched = True
+            if pair not in known_tags:
+                if self.debug:
+                    self.stream.writeln('Creating tag %s' % data)
+                resp = self.session.post(self.tags_url, data=data)
+                self.raise_for_status(resp)
+                known_tags[pair] = json.loads(resp.text)['url']
+            tag_list.append(known_tags[pair])
         return tag_list
 
     def getPreviousTestRun(self):
-        params = {'project': self.project_id,}
-        if self.debug:
-            self.stream.writeln('%s %s' % (self.runs_url, params))
-        resp = self.session.get(self.runs_url, params=params)
-        self.raise_for_status(resp)
-        runs = json.loads(resp.text)
-        # only consider finished runs
-        runs = [run for run in runs if run['status'] != 'inprogress']
-        # filter manually, a list can't be put in a query string
+        # the server finds the most recent finished run with these tags
+        params = {
+            'project': self.project_id,
+            'tags': [self.id_from_url(tag) for tag in self.tags],
+        }
         if self.debug:
-            self.stream.writeln('Required tags: %s' % self.tags)
-        runs = [run for run in runs if run['tags'] == self.tags]
-        # then choose the most recent
-        runs = sorted(runs, key=lambda k: k['start_time'], reverse=True)
-        try:
-            return runs[0]['url']
-        except IndexError:
+            self.stream.writeln('%s %s' % (self.previous_run_url, params))
+        resp = self.session.get(self.previous_run_url, params=params)
+        if resp.status_code == 404:
             return None
+        self.raise_for_status(resp)
+        return json.loads(resp.text)['url']
 
     def failing(self, include_exists=True):
-        previous_run_id = self.id_from_url(self.getPreviousTestRun())
-        params = {'run': previous_run_id}
+        # the server picks out the failing names, one request for all of them
+        previous = self.getPreviousTestRun()
+        if not previous:
+            return []
+        url = previous + 'failing/'
+        params = {}
+        if include_exists:
+            params['exists'] = 1
         if self.debug:
-            self.stream.writeln('%s %s' % (self.results_url, params))
-        resp = self.session.get(self.results_url, params=params)
+            self.stream.writeln('%s %s' % (url, params))
+        resp = self.session.get(url, params=params)
         self.raise_for_status(resp)
-        failing = []
-        failing_statuses = ['fail']
-        if include_exists:
-            failing_statuses.append('exists')
-        for result in json.loads(resp.text):
-            if result['status'] in failing_statuses:
-                resp = self.session.get(result['case'])
-                self.raise_for_status(resp)
-                failing.append(json.loads(resp.text)['name'])
-        return failing
+        return json.loads(resp.text)
 
     # methods for run
     def startTestRun(self, timestamp=None):
+        if self.journal:
+            # the tag values are recorded as they are now, not at replay
+            self.journal.record('startTestRun', run_url=self._run_url,
+                                timestamp=timestamp, tags=self.tagValues(),
+                                offline=self.offline)
+        if self.offline:
+            return
+        run_url = self._run_url
+        try:
+            self._startTestRun(timestamp)
+        except WRTRequestFailed:
+            # the first write to use what came from the cache
+            # will find out if it is stale, if so try again without it
+            if not self.cache.loaded:
+                raise
+            self.stream.writeln('WARNING: Cached well-rested-tests data is stale, '
+                                'looking it up again.')
+            self.cache.invalidate()
+            self._project_url = None
+            self._user_url = None
+            self._tags = []
+            self._run_url = run_url
+            self._startTestRun(timestamp)
+        self.cache.save()
+
+    def _startTestRun(self, timestamp=None):
         if self._run_url == 'previous':
             # may return None
             self._run_url = self.getPreviousTestRun()
@@ -319,6 +769,10 @@ class WRTClient(object):
 
     def stopTestRun(self, **kwargs):
         timestamp = kwargs.pop('timestamp', None)
+        if self.journal:
+            self.journal.record('stopTestRun', timestamp=timestamp, kwargs=kwargs)
+        if self.offline:
+            return
         kwargs['end_time'] = timestamp
         kwargs['owner'] = self.user_url
         kwargs['project'] = self.project_url
@@ -328,7 +782,139 @@ class WRTClient(object):
         resp = self.session.put(self._run_url, data=kwargs)
         self.raise_for_status(resp)
 
+    def flush(self):
+        """Wait for queued updates to be sent, then send any status
+        updates still waiting for a stop."""
+        if self.sender:
+            failures = self.sender.flush()
+            if failures:
+                self.stream.writeln(
+                    'WARNING: %s update(s) to the well-rested-tests server failed'
+                    % failures)
+        if self._uploads:
+            failures = self._uploads.flush()
+            if failures:
+                self.stream.writeln(
+                    'WARNING: %s detail upload(s) to the well-rested-tests server failed'
+                    % failures)
+            shown, self._shown = self._shown, []
+            links = ['%s %s: %s' % (shown_as, name, upload.url)
+                     for shown_as, name, upload in shown if upload.url]
+            if links:
+                self.stream.writeln('Details uploaded to the well-rested-tests server:')
+                for link in links:
+                    self.stream.writeln('  %s' % link)
+        while self._pending:
+            result_url, data = self._pending.popitem()
+            resp = self.session.put(result_url, data=data)
+            self.raise_for_status(resp)
+
+    def close(self):
+        """Flush, and make any further updates immediately."""
+        self.flush()
+        if self.sender:
+            self.sender.stop()
+            self.sender = None
+        if self._uploads:
+            self._uploads.stop()
+            self._uploads = None
+        self.cache.save()
+
+    # methods for details
+    def uploadDetails(self, result_url, prefix, details, shown_as=None):
+        """
+        Upload the details and attach them to the result, from the upload
+        threads. The details themselves are left as they are, so reading
+        them doesn't wait for the uploads; flush() does.
+
+        :param prefix: start of the uploaded objects' names
+        :param shown_as: if given, flush() prints the uploaded details' urls
+            under it, as they can't be printed with the details themselves
+        """
+        for name, value in details.items():
+            spool = None
+            if value.content_type == content.URL:
+                url = value.as_text().strip()  # urls pass-thru to detail stage
+                tp = url.split('.')[-1]
+                # we can't upload things sent to local storage
+                if url.startswith('file://'):
+                    if self.debug:
+                        self.stream.writeln('skipping upload of %s' % name)
+                    continue
+            else:
+                url = None
+                if value.content_type.type == 'application':
+                    tp = value.content_type.subtype
+                elif value.content_type.type == 'text':
+                    tp = value.content_type.type
+                else:
+                    continue
+                # read a chunk at a time, rather than all at once
+                # and compress text, which is most of it
+                chunks = value.iter_bytes()
+                if tp == 'text':
+                    chunks = _stripped(chunks)
+                spool = _Spool(chunks,
+                               encoding=self.compression if tp == 'text' else None)
+                if not spool.size:
+                    spool.close()
+                    continue  # empty attachments pass thru
+            # object named for prefix, content name and type
+            filename = '%s-%s.%s' % (prefix, name, tp)
+            upload = _Upload(spool, url)
+            if shown_as and spool:
+                self._shown.append((shown_as, name, upload))
+            self.uploads.put(
+                upload, self.uploadDetail, result_url, name, tp, filename)
+
+    def attachmentUrl(self, session, digest):
+        """The url of content already on the server, or None."""
+        if digest not in self._attachments:
+            resp = session.get(self.attachments_url, params={'digest': digest})
+            self.raise_for_status(resp)
+            attachments = json.loads(resp.text)
+            if not attachments:
+                return None
+            self._attachments[digest] = attachments[0]['file_url']
+        return self._attachments[digest]
+
+    def uploadDetail(self, session, upload, result_url, name, tp, filename):
+        url = upload.url
+        if upload.spool:
+            # only upload content the server hasn't got already
+            url = self.attachmentUrl(session, upload.spool.digest)
+        if not url:
+            headers = {
+                'Content-Type': 'application/octet-stream',
+                'Content-Disposition': 'attachment; filename="%s"' % filename,
+            }
+            if upload.spool.encoding:
+                headers['Content-Encoding'] = upload.spool.encoding
+            if self.debug:
+                self.stream.writeln('uploading attachment %s %s %s bytes'
+                                    % (self.attachments_url, name, upload.spool.len))
+            resp = session.post(self.attachments_url, data=upload.spool,
+                                headers=headers)
+            self.raise_for_status(resp)
+            url = json.loads(resp.text)['file_url']
+            self._attachments[upload.spool.digest] = url
+
+        # create a detail by attaching the attachment to a result
+        data = {
+            'file_url': url,
+            'file_type': tp,
+            'name': name,
+            'result': result_url,
+        }
+        if self.debug:
+            self.stream.writeln('adding detail %s %s' % (self.details_url, data))
+        resp = session.post(self.details_url, data=data)
+        self.raise_for_status(resp)
+        return url
+
     # methods for tests
+    @queueable
+    @journaled
     def startTest(self, test, timestamp=None):
         result_url = self._existing_tests[test.id()]['result_url']
         data = {
@@ -343,54 +929,13 @@ class WRTClient(object):
         resp = self.session.put(result_url, data=data)
         self.raise_for_status(resp)
 
+    @queueable
+    @journaled
     def markTestStatus(self, test, status, reason=None, details=None):
         result_url = self._existing_tests[test.id()]['result_url']
-        # upload details
         if details:
-            for name, value in details.items():
-                if value.content_type == content.URL:
-                    url = value.as_text().strip()  # urls pass-thru to detail stage
-                    tp = url.split('.')[-1]
-                    # we can't upload things sent to local storage
-                    if url.startswith('file://'):
-                        if self.debug:
-                            print('skipping upload of %s' % name)
-                        continue
-                else:
-                    attachment = None
-                    if value.content_type.type == 'application':
-                        tp = value.content_type.subtype
-                        attachment = value.as_bytes()
-                    elif value.content_type.type == 'text':
-                        tp = value.content_type.type
-                        attachment = value.as_text().strip()
-                    if not attachment:
-                        continue  # empty attachments pass thru
-                    # object named for test id, content name and type
-                    filename = '%s-%s.%s' % (test.id(), name, tp)
-                    # TODO: chunked?
-                    if self.debug:
-                        self.stream.writeln('uploading attachment %s %s'
-                                            % (self.attachments_url, name))
-                    resp = self.session.post(self.attachments_url,
-                                             files={'file': (filename, attachment)})
-                    self.raise_for_status(resp)
-                    url = json.loads(resp.text)['file_url']
-
-                # create a detail by attaching the attachment to a result
-                data = {
-                    'file_url': url,
-                    'file_type': tp,
-                    'name': name,
-                    'result': result_url,
-                }
-                if self.debug:
-                    self.stream.writeln('adding detail %s %s' % (self.details_url, data))
-                resp = self.session.post(self.details_url, data=data)
-                self.raise_for_status(resp)
-
-                # replace the detail content with a url for printing
-                details[name] = content.url_content(url)
+            self.uploadDetails(result_url, test.id(), details,
+                               shown_as=test.id() if status == 'fail' else None)
         # update the result
         data = {
             'status': status,
@@ -399,6 +944,10 @@ class WRTClient(object):
             'owner': self.user_url,
             'reason': reason,
         }
+        if self.coalesce:
+            # sent with the stopTest update
+            self._pending[result_url] = data
+            return details
         if self.debug:
             self.stream.writeln('Marking test %s %s' % (result_url, data))
         resp = self.session.put(result_url, data=data)
@@ -406,6 +955,8 @@ class WRTClient(object):
 
         return details
 
+    @queueable
+    @journaled
     def stopTest(self, test, timestamp=None, duration=None):
         result_url = self._existing_tests[test.id()]['result_url']
         data = {
@@ -415,13 +966,31 @@ class WRTClient(object):
             'run': self._run_url,
             'owner': self.user_url,
         }
+        data.update(self._pending.pop(result_url, {}))
         if self.debug:
             self.stream.writeln('Stopping test %s %s' % (result_url, data))
         resp = self.session.put(result_url, data=data)
         self.raise_for_status(resp)
 
     # methods for fixtures
+    @queueable
+    @journaled
     def startFixture(self, fixture, timestamp):
+        try:
+            self._startFixture(fixture, timestamp)
+        except WRTRequestFailed:
+            # the first write to use a case url from the cache will
+            # find out if it is stale, if so try again without it
+            if fixture.id() not in self._unconfirmed_fixtures:
+                raise
+            self.stream.writeln('WARNING: Cached well-rested-tests case for %s is '
+                                'stale, looking it up again.' % fixture.id())
+            self._unconfirmed_fixtures.discard(fixture.id())
+            del self._existing_fixtures[fixture.id()]
+            self.cache.get('fixtures', {}).pop(fixture.id(), None)
+            self._startFixture(fixture, timestamp)
+
+    def _startFixture(self, fixture, timestamp):
         # find or create the case
         try:  # find out if we've seen it locally before
             case_url = self._existing_fixtures[fixture.id()]['case_url']
@@ -444,6 +1013,7 @@ class WRTClient(object):
                 case_url = json.loads(resp.text)['url']
             # save it locally
             self._existing_fixtures[fixture.id()] = {'case_url': case_url}
+            self.cache.update('fixtures', {fixture.id(): case_url})
         # always create a new result
         data = {
             'case': case_url,
@@ -456,71 +1026,22 @@ class WRTClient(object):
             self.stream.writeln('Starting fixture %s %s' % (fixture.id(), data))
         resp = self.session.post(self.results_url, data=data)
         self.raise_for_status(resp)
-        self._existing_fixtures[fixture.id()]['result_url'] = json.loads(resp.text)['url']
+        self._unconfirmed_fixtures.discard(fixture.id())
+        self._fixture_results[use_id(fixture)] = json.loads(resp.text)['url']
 
+    @queueable
+    @journaled
     def markFixtureStatus(self, fixture, status, details=None, reason=None):
-        result_url = self._existing_fixtures[fixture.id()]['result_url']
-        # upload details
+        result_url = self._fixture_results[use_id(fixture)]
         if status == 'fail' and details:
-            for name, value in details.items():
-                # TODO: contemplate whether all content types are created equal
-                if value.content_type == content.URL:
-                    url = value.as_text().strip()
-                    tp = url.split('.')[-1]
-                    # we can't upload things sent to local storage
-                    if url.startswith('file://'):
-                        if self.debug:
-                            print('skipping upload of %s' % name)
-                        continue
-                else:
-                    attachment = None
-                    if value.content_type.type == 'application':
-                        tp = value.content_type.subtype
-                        attachment = value.as_bytes()
-                    elif value.content_type.type == 'text':
-                        tp = value.content_type.type
-                        attachment = value.as_text().strip()
-                    if not attachment:
-                        continue  # empty attachments pass thru
-                    # get rid of weird stuff in pythonlogging name
-                    if ":''" in name:
-                        details.pop(name)
-                        name = name.replace(":''", "")
-                    # object named for result id, fixture id, content name and type
-                    # (fixture id isn't unique per run)
-                    filename = '%s-%s-%s.%s' % (
-                        self.id_from_url(result_url), fixture.id(), name, tp)
-
-                    # TODO: chunked?
-                    headers = {
-                        'Content-Type': '%s/%s' % (
-                            value.content_type.type, value.content_type.subtype),
-                        'Content-length': len(attachment),
-                        'Content-Disposition': 'attachment; filename=%s' % filename
-                    }
-                    if self.debug:
-                        self.stream.writeln('uploading attachment %s %s %s'
-                                            % (self.attachments_url, name, headers))
-                    resp = self.session.post(self.attachments_url,
-                                             data={'file': attachment},
-                                             headers=headers)
-                    self.raise_for_status(resp)
-                    url = json.loads(resp.text)['file_url']
-
-                # create a detail by attaching the attachment to a result
-                data = {
-                    'file_url': url,
-                    'file_type': tp,
-                    'name': name,
-                    'result': result_url,
-                }
-                if self.debug:
-                    self.stream.writeln('adding detail %s %s' % (self.details_url, data))
-                resp = self.session.post(self.details_url, data=data)
-                self.raise_for_status(resp)
-
-                # replace the detail content with a url for printing
-                details[name] = content.url_content(url)
+            # get rid of weird stuff in pythonlogging name
+            for name in details.keys():
+                if ":''" in name:
+                    details[name.replace(":''", "")] = details.pop(name)
+            # object named for result id too (fixture id isn't unique per run)
+            self.uploadDetails(
+                result_url, '%s-%s' % (self.id_from_url(result_url), fixture.id()),
+                details, shown_as=fixture.id())
         data = {
             'status': status,
             'case': self._existing_fixtures[fixture.id()]['case_url'],
@@ -528,15 +1049,21 @@ class WRTClient(object):
             'owner': self.user_url,
             'reason': reason,
         }
+        if self.coalesce:
+            # sent with the stopFixture update
+            self._pending[result_url] = data
+            return details
         if self.debug:
             self.stream.writeln('Marking fixture %s %s' % (result_url, data))
         resp = self.session.put(result_url, data=data)
         self.raise_for_status(resp)
         return details
 
+    @queueable
+    @journaled
     def stopFixture(self, fixture, timestamp, duration=None):
         # get rid of the result_url when done with this method
-        result_url = self._existing_fixtures[fixture.id()].pop('result_url')
+        result_url = self._fixture_results.pop(use_id(fixture))
         data = {
             'end_time': timestamp,
             'duration': duration,
@@ -544,6 +1071,7 @@ class WRTClient(object):
             'run': self._run_url,
             'owner': self.user_url,
         }
+        data.update(self._pending.pop(result_url, {}))
         if self.debug:
             self.stream.writeln('Stopping fixture %s %s' % (result_url, data))
         resp = self.session.put(result_url, data=data)
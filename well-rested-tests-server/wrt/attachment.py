@@ -1,22 +1,88 @@
 import datetime
+import hashlib
+import mimetypes
+import zlib
 from django.db import models         # models.py
 from django.shortcuts import render  # views.py
+from django.shortcuts import get_object_or_404
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
 from django.contrib import admin     # admin.py
 from django.test import TestCase     # tests.py
 from rest_framework import serializers, viewsets
+from rest_framework.parsers import MultiPartParser, FileUploadParser
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework import status
+from django.db import transaction, IntegrityError
 
 from result import Result
 import permissions
 
 
 def upload_to(instance, filename):
+    # stored by content, so the same content is only stored once
+    if instance.digest:
+        return '%s/%s/%s' % (instance.digest[:2], instance.digest, filename)
     return datetime.datetime.now().strftime('%Y%m%d/') + filename
 
 
+def gunzip(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+# Content-Encodings attachments may be uploaded with,
+# and how to decompress them
+ENCODINGS = {
+    '': lambda chunks: chunks,
+    'gzip': gunzip,
+}
+
+
+def accepts_encoding(accept_encoding, encoding):
+    """Whether an Accept-Encoding header accepts `encoding`,
+    by name or by *, and with a q-value above 0."""
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        params = [param.strip() for param in item.split(';')]
+        coding = params[0].lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding] = qvalue
+    if encoding == 'gzip' and 'x-gzip' in qvalues:
+        qvalues.setdefault('gzip', qvalues['x-gzip'])
+    return qvalues.get(encoding, qvalues.get('*', 0.0)) > 0
+
+
+def file_digest(upload):
+    sha = hashlib.sha256()
+    for chunk in upload.chunks():
+        sha.update(chunk)
+    upload.seek(0)
+    return sha.hexdigest()
+
+
 class Attachment(models.Model):
     # this is for the case where the user doesn't want to upload
     # their objects to swift
     file = models.FileField(upload_to=upload_to, null=False, blank=False)
+    # sha256 of the file, attachments from before there was one have none
+    digest = models.CharField(max_length=64, unique=True, null=True,
+                              blank=True, editable=False)
+    # how the file is compressed, if it is (from the Content-Encoding it came with)
+    encoding = models.CharField(max_length=16, blank=True, default='',
+                                editable=False)
 
     @property
     def file_url(self):
@@ -27,19 +93,82 @@ class Attachment(models.Model):
 
 
 class AttachmentAdmin(admin.ModelAdmin):
-    list_display = ('id', 'file', 'file_url')
+    list_display = ('id', 'file', 'file_url', 'digest', 'encoding')
 
 
 class AttachmentSerializer(serializers.HyperlinkedModelSerializer):
+    file_url = serializers.SerializerMethodField()
+
     class Meta:
         model = Attachment
-        fields = ('id', 'file', 'file_url')
+        fields = ('id', 'file', 'file_url', 'digest', 'encoding')
+
+    def get_file_url(self, attachment):
+        # compressed files are served by attachment(), which can decompress them
+        if attachment.encoding:
+            return reverse('attachment', args=[attachment.id],
+                           request=self.context.get('request'))
+        return attachment.file_url
 
 
 class AttachmentViewSet(viewsets.ModelViewSet):
     queryset = Attachment.objects.all()
     serializer_class = AttachmentSerializer
     permission_classes = (permissions.CreateOnly,)
+    # the file as a form field, or streamed as the whole body
+    # (named by the Content-Disposition header)
+    parser_classes = (MultiPartParser, FileUploadParser)
+    # GET ?digest=<sha256> to find out if the content is already here
+    filter_fields = ('digest',)
+
+    def create(self, request, *args, **kwargs):
+        """
+        Stores the file, unless a file with the same content is
+        already stored, in which case that attachment is returned.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '')
+        if encoding not in ENCODINGS:
+            return Response({'encoding': 'Content-Encoding must be one of %s'
+                                         % ENCODINGS.keys()},
+                            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        digest = file_digest(serializer.validated_data['file'])
+        attachment = Attachment.objects.filter(digest=digest).first()
+        if attachment:
+            return Response(self.get_serializer(attachment).data,
+                            status=status.HTTP_200_OK)
+        try:
+            with transaction.atomic():
+                attachment = serializer.save(digest=digest, encoding=encoding)
+        except IntegrityError:
+            # the same content was stored while we were reading it
+            attachment = Attachment.objects.get(digest=digest)
+            return Response(self.get_serializer(attachment).data,
+                            status=status.HTTP_200_OK)
+        return Response(self.get_serializer(attachment).data,
+                        status=status.HTTP_201_CREATED)
+
+
+def attachment(request, attachment_id):
+    """
+    Serves an attachment as it is stored if the browser accepts its
+    encoding, and decompresses it on the way out if not.
+    """
+    attachment = get_object_or_404(Attachment, pk=attachment_id)
+    content_type = mimetypes.guess_type(attachment.file.name)[0] or 'text/plain'
+    attachment.file.open('rb')
+    if attachment.encoding and accepts_encoding(
+            request.META.get('HTTP_ACCEPT_ENCODING', ''), attachment.encoding):
+        response = FileResponse(attachment.file, content_type=content_type)
+        response['Content-Encoding'] = attachment.encoding
+    else:
+        response = StreamingHttpResponse(
+            ENCODINGS[attachment.encoding](attachment.file.chunks()),
+            content_type=content_type)
+    if attachment.encoding:
+        patch_vary_headers(response, ['Accept-Encoding'])
+    return response
 
 
 class Detail(models.Model):
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def fingerprint_runs(apps, schema_editor):
+    from wrt.run import tag_fingerprint
+    Run = apps.get_model('wrt', 'Run')
+    for run in Run.objects.all():
+        run.tag_fingerprint = tag_fingerprint(run.tags.values_list('id', flat=True))
+        run.save(update_fields=['tag_fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrt', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='tag_fingerprint',
+            field=models.CharField(default='', max_length=40, editable=False, blank=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='run',
+            index_together=set([('project', 'tag_fingerprint', 'start_time')]),
+        ),
+        migrations.RunPython(fingerprint_runs, migrations.RunPython.noop),
+    ]
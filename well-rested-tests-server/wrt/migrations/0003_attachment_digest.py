@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrt', '0002_run_tag_fingerprint'),
+    ]
+
+    # existing attachments are left without a digest, the same content
+    # may be stored more than once among them
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='digest',
+            field=models.CharField(null=True, editable=False, max_length=64, blank=True, unique=True),
+        ),
+    ]
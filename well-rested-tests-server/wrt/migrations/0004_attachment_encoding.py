@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrt', '0003_attachment_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='encoding',
+            field=models.CharField(default='', max_length=16, editable=False, blank=True),
+        ),
+    ]
@@ -3,8 +3,12 @@ from django.shortcuts import render  # views.py
 from django.contrib import admin     # admin.py
 from django.test import TestCase     # tests.py
 from rest_framework import serializers, viewsets
+from rest_framework.decorators import list_route
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from django.contrib.auth.models import User
 from django.shortcuts import render, get_object_or_404
+from django.db import transaction
 
 from run import Run
 from case import Case
@@ -73,6 +77,48 @@ class ResultViewSet(viewsets.ModelViewSet):
     permission_classes = (permissions.OnlyAdminCanDelete,)
     filter_fields = ('run', 'case', 'start_time', 'owner', 'status', 'reason')
 
+    @list_route(methods=['post'])
+    def register(self, request):
+        """
+        Find or create the cases and 'exists' results for many tests at once.
+
+        POST {"run": <run id>, "names": [<test id>, ...]}
+        returns {<test id>: {"case_id", "case_url", "result_id", "result_url"}}
+        """
+        run = get_object_or_404(Run, pk=request.data.get('run'))
+        names = set(request.data.get('names', []))
+        with transaction.atomic():
+            cases = Case.objects.filter(project=run.project, fixture=False)
+            case_ids = dict(cases.filter(name__in=names).values_list('name', 'id'))
+            # one at a time, as another run may be registering the same
+            # new cases, and case names are unique
+            for name in names.difference(case_ids):
+                case, created = Case.objects.get_or_create(
+                    name=name, defaults={'project': run.project})
+                case_ids[name] = case.id
+
+            results = Result.objects.filter(run=run)
+            result_ids = dict(results.filter(
+                case__in=case_ids.values()).values_list('case', 'id'))
+            missing = set(case_ids.values()).difference(result_ids)
+            if missing:
+                Result.objects.bulk_create(
+                    [Result(run=run, case_id=case_id, owner=request.user, status='exists')
+                     for case_id in missing])
+                result_ids.update(results.filter(
+                    case__in=missing).values_list('case', 'id'))
+
+        registered = {}
+        for name, case_id in case_ids.items():
+            result_id = result_ids[case_id]
+            registered[name] = {
+                'case_id': case_id,
+                'case_url': reverse('case-detail', args=[case_id], request=request),
+                'result_id': result_id,
+                'result_url': reverse('result-detail', args=[result_id], request=request),
+            }
+        return Response(registered)
+
 
 def result(request, result_id):
     result = get_object_or_404(Result, pk=result_id)
@@ -3,14 +3,29 @@ from django.shortcuts import render  # views.py
 from django.contrib import admin     # admin.py
 from django.test import TestCase     # tests.py
 from rest_framework import serializers, viewsets
+from rest_framework.decorators import list_route, detail_route
+from rest_framework.response import Response
 from django.contrib.auth.models import User
 from django.shortcuts import render, get_object_or_404
+from django.db.models.signals import m2m_changed, pre_delete, post_delete
+from django.dispatch import receiver
+from django.http import Http404
+import hashlib
 
 from project import Project
 from tag import Tag
 import permissions
 
 
+def tag_fingerprint(tag_ids):
+    """Identifies a set of tags, so that runs with the same tags
+    can be found with one indexed lookup."""
+    tag_ids = sorted(set(int(tag_id) for tag_id in tag_ids))
+    if not tag_ids:
+        return ''
+    return hashlib.sha1(','.join(str(tag_id) for tag_id in tag_ids)).hexdigest()
+
+
 class Run(models.Model):
     project = models.ForeignKey(Project)
     owner = models.ForeignKey(User, null=True, blank=True)
@@ -28,6 +43,12 @@ class Run(models.Model):
         )
     )
     tags = models.ManyToManyField(Tag, blank=True)
+    # kept up to date with tags by update_tag_fingerprint()
+    tag_fingerprint = models.CharField(
+        max_length=40, blank=True, default='', editable=False)
+
+    class Meta:
+        index_together = [('project', 'tag_fingerprint', 'start_time')]
 
     @property
     def duration(self):
@@ -96,6 +117,41 @@ class Run(models.Model):
         return ' '.join(tags)
 
 
+def update_tag_fingerprints(runs):
+    for run in runs:
+        run.tag_fingerprint = tag_fingerprint(run.tags.values_list('id', flat=True))
+        run.save(update_fields=['tag_fingerprint'])
+
+
+@receiver(m2m_changed, sender=Run.tags.through)
+def update_tag_fingerprint(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # clearing a tag's runs doesn't say which runs they were
+        instance._cleared_runs = list(instance.run_set.values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:  # the tag's runs changed
+        if action == 'post_clear':
+            pk_set = instance.__dict__.pop('_cleared_runs', [])
+        runs = Run.objects.filter(pk__in=pk_set or [])
+    else:
+        runs = [instance]
+    update_tag_fingerprints(runs)
+
+
+@receiver(pre_delete, sender=Tag)
+def note_tag_runs(sender, instance, **kwargs):
+    # deleting a tag removes it from its runs without m2m_changed
+    instance._deleted_from_runs = list(instance.run_set.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+def update_deleted_tag_fingerprints(sender, instance, **kwargs):
+    update_tag_fingerprints(Run.objects.filter(
+        pk__in=instance.__dict__.pop('_deleted_from_runs', [])))
+
+
 class RunAdmin(admin.ModelAdmin):
     list_display = ('id', 'start_time', 'end_time', 'duration', 'status', 'description',
                     'results', 'tests_run', 'failures', 'xpasses', 'xfails')
@@ -120,6 +176,39 @@ class RunViewSet(viewsets.ModelViewSet):
     # don't try to filter by tags, they can't be made into a query string
     filter_fields = ('project', 'status')
 
+    @list_route()
+    def previous(self, request):
+        """
+        The most recent finished run of a project with exactly these tags.
+
+        GET ?project=<project id>&tags=<tag id>&tags=<tag id>...
+        """
+        run = Run.objects.filter(
+            project=request.query_params.get('project'),
+            tag_fingerprint=tag_fingerprint(request.query_params.getlist('tags')),
+        ).exclude(status='inprogress').exclude(start_time=None
+        ).order_by('-start_time').first()
+        if not run:
+            raise Http404('No matching run')
+        return Response(self.get_serializer(run).data)
+
+    @detail_route()
+    def failing(self, request, pk=None):
+        """
+        Names of the tests that failed in this run, as a list.
+
+        GET ?exists=1 to include tests that never got a result.
+        """
+        from result import Result  # circular
+        run = self.get_object()
+        statuses = ['fail']
+        if request.query_params.get('exists'):
+            statuses.append('exists')
+        names = Result.objects.filter(
+            run=run, status__in=statuses, case__fixture=False,
+        ).order_by('case__name').values_list('case__name', flat=True)
+        return Response(list(names))
+
 
 def run(request, run_id):
     run = get_object_or_404(Run, pk=run_id)
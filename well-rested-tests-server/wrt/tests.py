@@ -0,0 +1,89 @@
+import datetime
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from project import Project
+from tag import Tag
+from run import Run, tag_fingerprint
+from attachment import accepts_encoding
+
+
+class PreviousRunTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        self.client.login(username='user', password='password')
+        self.project = Project.objects.create(name='project')
+        self.revision = Tag.objects.create(
+            project=self.project, name='REVISION', value='abc')
+        self.option = Tag.objects.create(
+            project=self.project, name='OPTION', value='x')
+        self.start = timezone.now()
+
+    def run_with(self, tags, minutes=0, status='pass'):
+        run = Run.objects.create(
+            project=self.project, owner=self.user, status=status,
+            start_time=self.start + datetime.timedelta(minutes=minutes))
+        run.tags.add(*tags)
+        return run
+
+    def previous(self, tags):
+        return self.client.get('/api/runs/previous/', {
+            'project': self.project.id,
+            'tags': [tag.id for tag in tags],
+        })
+
+    def test_most_recent_finished_run_with_the_same_tags(self):
+        self.run_with([self.revision, self.option], minutes=0)
+        expected = self.run_with([self.revision, self.option], minutes=1)
+        self.run_with([self.revision, self.option], minutes=2, status='inprogress')
+        self.run_with([self.revision], minutes=3)
+        resp = self.previous([self.option, self.revision])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['id'], expected.id)
+
+    def test_no_previous_run(self):
+        self.run_with([self.revision])
+        self.assertEqual(self.previous([self.option]).status_code, 404)
+
+    def test_fingerprint_follows_tags(self):
+        run = self.run_with([self.revision, self.option])
+        run.tags.remove(self.option)
+        run.refresh_from_db()
+        self.assertEqual(run.tag_fingerprint, tag_fingerprint([self.revision.id]))
+
+    def test_fingerprint_when_a_tag_is_cleared_from_its_runs(self):
+        run = self.run_with([self.revision, self.option])
+        self.option.run_set.clear()
+        run.refresh_from_db()
+        self.assertEqual(run.tag_fingerprint, tag_fingerprint([self.revision.id]))
+
+    def test_fingerprint_when_a_tag_is_deleted(self):
+        run = self.run_with([self.revision, self.option])
+        self.option.delete()
+        run.refresh_from_db()
+        self.assertEqual(run.tag_fingerprint, tag_fingerprint([self.revision.id]))
+
+
+class AcceptsEncodingTest(TestCase):
+
+    def test_listed(self):
+        self.assertTrue(accepts_encoding('gzip, deflate', 'gzip'))
+        self.assertTrue(accepts_encoding('deflate;q=0.5, GZIP;q=0.8', 'gzip'))
+        self.assertTrue(accepts_encoding('x-gzip', 'gzip'))
+
+    def test_not_listed(self):
+        self.assertFalse(accepts_encoding('', 'gzip'))
+        self.assertFalse(accepts_encoding('deflate', 'gzip'))
+        # not a substring match
+        self.assertFalse(accepts_encoding('notgzip', 'gzip'))
+
+    def test_refused(self):
+        self.assertFalse(accepts_encoding('gzip;q=0', 'gzip'))
+        self.assertFalse(accepts_encoding('gzip; q=0.0, deflate', 'gzip'))
+        self.assertFalse(accepts_encoding('*, gzip;q=0', 'gzip'))
+
+    def test_wildcard(self):
+        self.assertTrue(accepts_encoding('*', 'gzip'))
+        self.assertFalse(accepts_encoding('*;q=0', 'gzip'))
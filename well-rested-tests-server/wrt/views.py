@@ -6,6 +6,7 @@ from case import case
 from run import run
 from result import result, reason
 from tag import tag
+from attachment import attachment
 
 
 def index(request):
@@ -21,5 +22,6 @@ urlpatterns = [
     url(r'run/(?P<run_id>[0-9]+)/$', run, name='run'),
     url(r'result/(?P<result_id>[0-9]+)/$', result, name='result'),
     url(r'tag/(?P<tag_id>[0-9]+)/$', tag, name='tag'),
+    url(r'attachment/(?P<attachment_id>[0-9]+)/$', attachment, name='attachment'),
     url(r'reason/(?P<project_id>[0-9]+)/(?P<reason_name>[a-zA-Z1-9 _=]+)$', reason, name='reason'),
 ]